@@ -0,0 +1,276 @@
+"""Offline bulk decoding of archived raw reports.
+
+Handling reports one at a time through RequestHandler creates several
+objects per event, which is far too slow when decoding millions of archived
+reports.  decode_reports() verifies and walks the reports, but only copies
+the fixed-width event records into one buffer per subreport format.  The
+buffers are then converted in a single pass, using NumPy if it is
+available.
+
+The offline decoder does not apply the checks that only make sense for
+live traffic: the timestamp is not compared to the current time, replayed
+reports are not detected, and addresses are not checked with
+reportable_ip().  Unlike RequestHandler, it also ignores reports with a
+username longer than the 63 bytes that the specification allows.
+
+Each event only stores the index of its username, in a table of the
+usernames that is returned alongside the events, because the usernames
+would otherwise take most of the memory of the decoded events.
+"""
+
+import hmac
+import array
+import struct
+import hashlib
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from rps.report import EVENTS
+from rps.report import VERSION
+from rps.report import EndUser
+from rps.report import IPv4Events
+from rps.report import IPv6Events
+from rps.report import SoftwareName
+from rps.report import SoftwareVersion
+from rps.report import RepeatedIPv4Events
+from rps.report import RepeatedIPv6Events
+
+# The columns of the decoded events.  IPv4 addresses are stored in the
+# "ipv4" column, and IPv6 addresses are split over the "ipv6_high" and
+# "ipv6_low" columns; the "family" column says which of these is used.
+# Events that are not from a repeated events subreport have a repeat of 1.
+# The "user" column is the index of the username in the usernames list
+# that decode_reports() returns.
+EVENT_DTYPE = [
+    ("family", "u1"),
+    ("ipv4", "u4"),
+    ("ipv6_high", "u8"),
+    ("ipv6_low", "u8"),
+    ("event", "u1"),
+    ("repeat", "u1"),
+    ("user", "u4"),
+    ("timestamp", "u4"),
+]
+
+# The struct format, and NumPy dtype, of a single record in each of the
+# fixed-width subreport formats.
+_RECORDS = {
+    IPv4Events.format: (
+        "!IB", [("ipv4", ">u4"), ("event", "u1")]),
+    RepeatedIPv4Events.format: (
+        "!IBB", [("ipv4", ">u4"), ("event", "u1"), ("repeat", "u1")]),
+    IPv6Events.format: (
+        "!QQB", [("ipv6_high", ">u8"), ("ipv6_low", ">u8"),
+                 ("event", "u1")]),
+    RepeatedIPv6Events.format: (
+        "!QQBB", [("ipv6_high", ">u8"), ("ipv6_low", ">u8"),
+                  ("event", "u1"), ("repeat", "u1")]),
+}
+_WIDTHS = {
+    IPv4Events.format: IPv4Events.length,
+    RepeatedIPv4Events.format: RepeatedIPv4Events.length,
+    IPv6Events.format: IPv6Events.length,
+    RepeatedIPv6Events.format: RepeatedIPv6Events.length,
+}
+# The offset of the event type in each record, and whether the record
+# ends with a repeat.
+_EVENT_OFFSETS = {
+    IPv4Events.format: IPv4Events.length - 1,
+    RepeatedIPv4Events.format: RepeatedIPv4Events.length - 2,
+    IPv6Events.format: IPv6Events.length - 1,
+    RepeatedIPv6Events.format: RepeatedIPv6Events.length - 2,
+}
+_REPEATED = (RepeatedIPv4Events.format, RepeatedIPv6Events.format)
+_MAXIMUM_LENGTHS = dict((report_class.format, report_class.maximum_length)
+                        for report_class in (SoftwareName, SoftwareVersion,
+                                             EndUser))
+_FAMILIES = {
+    IPv4Events.format: 4,
+    RepeatedIPv4Events.format: 4,
+    IPv6Events.format: 6,
+    RepeatedIPv6Events.format: 6,
+}
+# The array.array type codes used by the pure-Python backend.
+_TYPECODES = {"u1": "B", "u4": "I", "u8": "Q"}
+
+
+class _Records(object):
+    """The raw records of one subreport format, with the username index and
+    timestamp of the report that each run of records came from."""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.users = array.array("I")
+        self.timestamps = array.array("I")
+        self.counts = []
+
+    def add(self, bytestr, count, user, timestamp):
+        self.data.extend(bytestr)
+        self.users.append(user)
+        self.timestamps.append(timestamp)
+        self.counts.append(count)
+
+
+def _split_report(report, passwords, password_cache):
+    """Verify a single report, and return the username, timestamp, and
+    a list of (format, bytes, count) tuples of the fixed-width subreports.
+
+    Return None if the report should be ignored."""
+    log = logging.getLogger("ip-reputation")
+    report = bytes(report)
+    if len(report) < 25:
+        log.info("Invalid report (%r).", report)
+        return None
+    signed, footer = report[:-10], report[-10:]
+    version, username_length = struct.unpack("!BB", signed[:2])
+    if version != VERSION:
+        log.info("Unknown version: %s", version)
+        return None
+    header_end = 2 + username_length + 12
+    if username_length > 63 or len(signed) < header_end:
+        log.info("Invalid report (%r).", report)
+        return None
+    raw_username = signed[2:2 + username_length]
+    try:
+        password = password_cache[raw_username]
+    except KeyError:
+        password = passwords.get(raw_username.decode("utf8", "replace"))
+        if password is not None and not isinstance(password, bytes):
+            password = password.encode("ascii")
+        password_cache[raw_username] = password
+    if not password:
+        log.debug("No password found.")
+        return None
+    digest = hmac.new(password, signed, hashlib.sha1).digest()[:10]
+    if not hmac.compare_digest(digest, footer):
+        log.info("Failed password check: %r.", raw_username)
+        return None
+    timestamp = struct.unpack("!I", signed[header_end - 4:header_end])[0]
+    chunks = []
+    position = header_end
+    while position < len(signed):
+        fmt = signed[position]
+        if fmt == 0:
+            break
+        if position + 3 > len(signed):
+            log.info("Truncated subreport header in %r.", raw_username)
+            return None
+        length = struct.unpack("!H", signed[position + 1:position + 3])[0]
+        start, position = position + 3, position + 3 + length
+        if position > len(signed):
+            log.info("Truncated subreport in %r.", raw_username)
+            return None
+        # An aggregator must skip over subreports with format values it
+        # does not understand, but must ignore the entire report if any
+        # subreports have invalid lengths.
+        if length >= _MAXIMUM_LENGTHS.get(fmt, 65536):
+            log.info("Invalid subreport length: %s", length)
+            return None
+        width = _WIDTHS.get(fmt)
+        if width is None:
+            continue
+        if length % width:
+            log.info("Invalid subreport length: %s", length)
+            return None
+        bytestr = signed[start:position]
+        # RequestHandler also ignores the entire report if an event type is
+        # unknown or a repeat is less than two.  Slicing out every event
+        # type (and repeat) byte keeps these checks out of a Python loop.
+        if length and max(bytestr[_EVENT_OFFSETS[fmt]::width]) >= len(EVENTS):
+            log.info("Unknown event type in %r.", raw_username)
+            return None
+        if length and fmt in _REPEATED and min(bytestr[width - 1::width]) < 2:
+            log.info("Invalid repeat in %r.", raw_username)
+            return None
+        chunks.append((fmt, bytestr, length // width))
+    return raw_username, timestamp, chunks
+
+
+def _numpy_columns(fmt, records):
+    """Convert the records of one format to a NumPy structured array."""
+    raw = numpy.frombuffer(bytes(records.data),
+                           dtype=numpy.dtype(_RECORDS[fmt][1]))
+    result = numpy.zeros(len(raw), dtype=EVENT_DTYPE)
+    result["family"] = _FAMILIES[fmt]
+    for name in raw.dtype.names:
+        result[name] = raw[name]
+    if "repeat" not in raw.dtype.names:
+        result["repeat"] = 1
+    result["user"] = numpy.repeat(
+        numpy.array(records.users, dtype="u4"), records.counts)
+    result["timestamp"] = numpy.repeat(
+        numpy.array(records.timestamps, dtype="u4"), records.counts)
+    return result
+
+
+def _python_columns(buffers):
+    """Convert the records of every format to a dictionary mapping the
+    column names to arrays."""
+    columns = dict((name, array.array(_TYPECODES[kind]))
+                   for name, kind in EVENT_DTYPE)
+    for fmt, records in buffers:
+        struct_format, fields = _RECORDS[fmt]
+        names = [name for name, dummy in fields]
+        unpacked = struct.iter_unpack(struct_format, bytes(records.data))
+        for user, timestamp, count in zip(
+                records.users, records.timestamps, records.counts):
+            for dummy in range(count):
+                record = dict(zip(names, next(unpacked)))
+                columns["family"].append(_FAMILIES[fmt])
+                columns["ipv4"].append(record.get("ipv4", 0))
+                columns["ipv6_high"].append(record.get("ipv6_high", 0))
+                columns["ipv6_low"].append(record.get("ipv6_low", 0))
+                columns["event"].append(record["event"])
+                columns["repeat"].append(record.get("repeat", 1))
+                columns["user"].append(user)
+                columns["timestamp"].append(timestamp)
+    return columns
+
+
+def decode_reports(reports, passwords, use_numpy=None):
+    """Decode an iterable of raw reports into a table of events, and return
+    it with a list of the usernames (as bytes) that its "user" column
+    indexes.
+
+    The passwords argument maps usernames to passwords.  Reports are
+    ignored if they have an unknown version or username, fail the HMAC
+    check, or have a subreport with an invalid length, an unknown event
+    type or a repeat of less than two, as RequestHandler does; see the
+    module docstring for the differences.
+
+    If NumPy is available (or use_numpy is true), the events are a NumPy
+    structured array with the EVENT_DTYPE columns.  Otherwise, they are a
+    dictionary mapping the same column names to array.array instances, so
+    that events["event"] works with either backend.  Events are grouped by
+    subreport format (IPv4, IPv6, repeated IPv4, repeated IPv6), and are
+    otherwise in the order that they were reported.
+    """
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    elif use_numpy and numpy is None:
+        raise ImportError("NumPy is required for use_numpy=True.")
+    buffers = dict((fmt, _Records()) for fmt in _RECORDS)
+    password_cache = {}
+    usernames = []
+    users = {}
+    for report in reports:
+        decoded = _split_report(report, passwords, password_cache)
+        if decoded is None:
+            continue
+        username, timestamp, chunks = decoded
+        try:
+            user = users[username]
+        except KeyError:
+            user = users[username] = len(usernames)
+            usernames.append(username)
+        for fmt, bytestr, count in chunks:
+            buffers[fmt].add(bytestr, count, user, timestamp)
+    buffers = sorted(buffers.items())
+    if not use_numpy:
+        return _python_columns(buffers), usernames
+    return numpy.concatenate([_numpy_columns(fmt, records)
+                              for fmt, records in buffers]), usernames
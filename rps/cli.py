@@ -0,0 +1,461 @@
+"""Command line tools for submitting and aggregating reports.
+
+rps-report streams "ip event [count]" lines (or JSON lines with "ip",
+"event" and "count" keys) from files or stdin, and sends them to an
+aggregator, for example for bulk backfills:
+
+    rps-report --server aggregator.example.com --username sensor \\
+        --password secret --rate 100 events.txt
+
+rps-server runs an aggregator, which by default prints the events that it
+receives in the same format, so the two can be used together for local
+end-to-end testing:
+
+    rps-server --user sensor:secret
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import importlib
+import ipaddress
+import collections
+
+from rps.report import PORT
+from rps.report import EVENTS
+from rps.report import EndUser
+from rps.report import IPEvent
+from rps.report import IPv4Events
+from rps.report import IPv6Events
+from rps.report import SoftwareName
+from rps.report import ReportClient
+from rps.report import ReportServer
+from rps.report import reportable_ip
+from rps.report import RequestHandler
+from rps.report import SoftwareVersion
+from rps.report import RepeatedIPEvent
+from rps.report import OVERFLOW_POLICIES
+from rps.report import PooledReportServer
+from rps.report import RepeatedIPv4Events
+from rps.report import RepeatedIPv6Events
+
+# Keep reports small enough to not be fragmented on a typical link.
+DEFAULT_MAX_SIZE = 1400
+# The largest UDP payload over IPv4.
+MAXIMUM_MAX_SIZE = 65507
+# The largest repeat that fits in a repeated event.
+MAXIMUM_REPEAT = 255
+
+
+class InvalidLine(ValueError):
+    """A line of input could not be parsed."""
+
+
+class UnreportableAddress(ValueError):
+    """A line of input has an address that must not be reported."""
+
+
+def parse_line(line):
+    """Parse a single line of input, and return an (address, event, count)
+    tuple, or None if the line is blank or a comment.
+
+    The line is either "ip event [count]" or a JSON object with "ip",
+    "event" and (optionally) "count" keys.
+    """
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    if line.startswith("{"):
+        try:
+            data = json.loads(line)
+            address, event = data["ip"], data["event"]
+            count = data.get("count", 1)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise InvalidLine(line)
+    else:
+        parts = line.split()
+        if len(parts) not in (2, 3):
+            raise InvalidLine(line)
+        address, event = parts[:2]
+        count = parts[2] if len(parts) == 3 else 1
+    try:
+        address = ipaddress.ip_address(address)
+        count = int(count)
+    except (ValueError, TypeError):
+        raise InvalidLine(line)
+    event = str(event).upper()
+    # Event type 0 is reserved. A sensor MUST NOT report events of type 0.
+    if event not in EVENTS[1:] or count < 1:
+        raise InvalidLine(line)
+    try:
+        reportable_ip(address)
+    except AssertionError:
+        raise UnreportableAddress(line)
+    return address, event, count
+
+
+class Stats(object):
+    """Counters for the progress and throughput of a submission."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.counts = collections.Counter()
+
+    def __getitem__(self, name):
+        return self.counts[name]
+
+    def add(self, name, amount=1):
+        self.counts[name] += amount
+
+    def format(self):
+        elapsed = max(time.time() - self.start, 1e-6)
+        return ("%.1fs: %d lines (%.0f/s), %d invalid, %d unreportable, "
+                "%d coalesced, %d events in %d reports (%.0f events/s, "
+                "%.1f reports/s), %d failed" % (
+                    elapsed, self["lines"], self["lines"] / elapsed,
+                    self["invalid"], self["unreportable"],
+                    self["coalesced"], self["events"], self["reports"],
+                    self["events"] / elapsed, self["reports"] / elapsed,
+                    self["failed"]))
+
+
+class ReportPacker(object):
+    """Pack events into as few reports as possible.
+
+    Events are added with add(), and whenever the next event would not fit
+    in a report of max_size bytes, send() is called with the subreports
+    that are pending.  Counts of two or more become repeated events (more
+    than one of them if the count is over 255), and everything else becomes
+    a plain event.  ValueError is raised if max_size is larger than a UDP
+    datagram, or too small for a report with any events.
+    """
+
+    def __init__(self, send, username, max_size=DEFAULT_MAX_SIZE,
+                 software_name=None, software_version=None, end_user=None):
+        if max_size > MAXIMUM_MAX_SIZE:
+            raise ValueError("The maximum report size is %d bytes." %
+                             MAXIMUM_MAX_SIZE)
+        self.send = send
+        # The version, username length, username, random bytes and
+        # timestamp; the end of report byte; and the HMAC.
+        overhead = 2 + len(username.encode("utf8")) + 12 + 1 + 10
+        for value in (software_name, software_version, end_user):
+            if value:
+                if not isinstance(value, bytes):
+                    value = value.encode("utf8")
+                overhead += 3 + len(value)
+        self.available = max_size - overhead
+        # There must be room for at least one subreport with one event.
+        if self.available < 3 + RepeatedIPv6Events.length:
+            raise ValueError("A report of %d bytes is too small to hold any "
+                             "events; at least %d bytes are needed." %
+                             (max_size, max_size - self.available + 3 +
+                              RepeatedIPv6Events.length))
+        self.subreports = {}
+        self.size = 0
+
+    def add(self, address, event, count=1):
+        v6 = address.version == 6
+        while count > 0:
+            if count == 1:
+                self.add_event(IPv6Events if v6 else IPv4Events,
+                               IPEvent(address, event))
+                count = 0
+            else:
+                repeat = min(count, MAXIMUM_REPEAT)
+                self.add_event(
+                    RepeatedIPv6Events if v6 else RepeatedIPv4Events,
+                    RepeatedIPEvent(address, event, repeat))
+                count -= repeat
+
+    def add_event(self, report_class, event):
+        pending = self.subreports.get(report_class)
+        size = report_class.length + (0 if pending else 3)
+        if self.size + size > self.available:
+            self.flush()
+            size = report_class.length + 3
+        self.subreports.setdefault(report_class, []).append(event)
+        self.size += size
+
+    def flush(self):
+        """Send any pending events."""
+        if not self.subreports:
+            return
+        subreports = [report_class(events) for report_class, events in
+                      sorted(self.subreports.items(),
+                             key=lambda item: item[0].format)]
+        self.subreports = {}
+        self.size = 0
+        self.send(subreports)
+
+
+class Submitter(object):
+    """Send packed subreports with a ReportClient, at a limited rate."""
+
+    def __init__(self, client, stats, rate=0):
+        self.client = client
+        self.stats = stats
+        self.interval = 1.0 / rate if rate else 0
+        self.next_send = time.time()
+
+    def __call__(self, subreports):
+        if self.interval:
+            delay = self.next_send - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.next_send = max(self.next_send, time.time()) + self.interval
+        events = sum(len(subreport.events) for subreport in subreports)
+        self.client.events = subreports
+        # Packed reports are as large as possible, so a short one is only
+        # sent when it is the last, and not sending it would lose data.
+        self.client.send_report(force=True)
+        if self.client.events:
+            # send_report() logs the failure; do not try again when the
+            # client is garbage-collected.
+            self.client.events = []
+            self.stats.add("failed")
+            return
+        self.stats.add("reports")
+        self.stats.add("events", events)
+
+
+def submit(lines, packer, stats, window=100000, progress=None,
+           progress_interval=10):
+    """Parse, validate and coalesce the lines, and pass them to the packer.
+
+    At most window distinct (address, event) pairs are kept in memory; once
+    there are more, the oldest are passed on to the packer.
+    """
+    log = logging.getLogger("ip-reputation")
+    pending = collections.OrderedDict()
+    last_progress = time.time()
+    for line in lines:
+        stats.add("lines")
+        try:
+            parsed = parse_line(line)
+        except UnreportableAddress:
+            stats.add("unreportable")
+            continue
+        except InvalidLine:
+            log.debug("Ignoring invalid line: %r", line)
+            stats.add("invalid")
+            continue
+        if parsed is None:
+            continue
+        address, event, count = parsed
+        key = (address, event)
+        if key in pending:
+            pending[key] += count
+            stats.add("coalesced")
+        else:
+            pending[key] = count
+            if len(pending) > window:
+                (address, event), count = pending.popitem(last=False)
+                packer.add(address, event, count)
+        if progress and time.time() - last_progress >= progress_interval:
+            last_progress = time.time()
+            progress(stats)
+    for (address, event), count in pending.items():
+        packer.add(address, event, count)
+    packer.flush()
+
+
+def _read_lines(paths):
+    """Yield the lines of each path, where "-" is stdin."""
+    for path in paths:
+        if path == "-":
+            for line in sys.stdin:
+                yield line
+            continue
+        with open(path) as input_file:
+            for line in input_file:
+                yield line
+
+
+def report_main(argv=None):
+    """The rps-report entry point."""
+    parser = argparse.ArgumentParser(
+        description="Send events to an IP reputation aggregator.")
+    parser.add_argument("paths", nargs="*", default=["-"], metavar="PATH",
+                        help="Files of 'ip event [count]' or JSON lines "
+                             "(default: stdin).")
+    parser.add_argument("--server", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--username", required=True)
+    parser.add_argument("--password", default=os.environ.get("RPS_PASSWORD"),
+                        help="Defaults to $RPS_PASSWORD.")
+    parser.add_argument("--software-name")
+    parser.add_argument("--software-version")
+    parser.add_argument("--end-user")
+    parser.add_argument("--timeout", type=float, default=10)
+    parser.add_argument("--rate", type=float, default=0,
+                        help="Maximum reports per second (default: no "
+                             "limit).")
+    parser.add_argument("--max-size", type=int, default=DEFAULT_MAX_SIZE,
+                        help="Maximum report size, in bytes.")
+    parser.add_argument("--window", type=int, default=100000,
+                        help="Maximum distinct (ip, event) pairs to keep "
+                             "for coalescing.")
+    parser.add_argument("--progress", type=float, default=10,
+                        help="Seconds between progress updates (0 to "
+                             "disable).")
+    args = parser.parse_args(argv)
+    if not args.password:
+        parser.error("A password is required.")
+    # The end user subreport is opaque bytes, so is not encoded for us.
+    end_user = args.end_user.encode("utf8") if args.end_user else None
+    for option, value, maximum_length in (
+            ("--username", args.username, 64),
+            ("--software-name", args.software_name,
+             SoftwareName.maximum_length),
+            ("--software-version", args.software_version,
+             SoftwareVersion.maximum_length),
+            ("--end-user", end_user, EndUser.maximum_length)):
+        if value and not isinstance(value, bytes):
+            value = value.encode("utf8")
+        if value and len(value) >= maximum_length:
+            parser.error("%s must be less than %d bytes." %
+                         (option, maximum_length))
+    if args.software_version and not args.software_name:
+        parser.error("--software-version requires --software-name.")
+    logging.basicConfig(level=logging.INFO)
+    stats = Stats()
+    client = ReportClient(args.timeout, args.server, args.username,
+                          args.password, port=args.port,
+                          software_name=args.software_name,
+                          software_version=args.software_version,
+                          end_user=end_user)
+    try:
+        packer = ReportPacker(Submitter(client, stats, args.rate),
+                              args.username, args.max_size,
+                              args.software_name, args.software_version,
+                              end_user)
+    except ValueError as e:
+        parser.error("--max-size: %s" % e)
+
+    def progress(stats):
+        print(stats.format(), file=sys.stderr)
+
+    submit(_read_lines(args.paths), packer, stats, args.window,
+           progress if args.progress else None, args.progress)
+    print(stats.format(), file=sys.stderr)
+    return 1 if stats["failed"] else 0
+
+
+class PrintHandler(RequestHandler):
+    """Print each event in the format that rps-report reads."""
+
+    def handle_events(self, username, events, software_name,
+                      software_version, end_user):
+        for event in events:
+            print(event.address, event.event, getattr(event, "repeat", 1))
+        sys.stdout.flush()
+
+
+class _PasswordsMixin(object):
+    """Look up passwords in the server's passwords dictionary."""
+
+    def get_password(self, username):
+        return self.server.passwords.get(username)
+
+
+def load_handler(name):
+    """Import a RequestHandler subclass from a "module:Class" name.
+
+    Raise argparse.ArgumentTypeError if there is no such class, so that it
+    can be used as an argument type.
+    """
+    module_name, sep, class_name = name.partition(":")
+    if not sep or not module_name or not class_name:
+        raise argparse.ArgumentTypeError("Expected module:Class")
+    try:
+        handler = getattr(importlib.import_module(module_name), class_name)
+    except (ImportError, AttributeError) as e:
+        raise argparse.ArgumentTypeError("Unable to load %s: %s" % (name, e))
+    if not (isinstance(handler, type) and
+            issubclass(handler, RequestHandler)):
+        raise argparse.ArgumentTypeError(
+            "%s is not a RequestHandler subclass" % name)
+    return handler
+
+
+def make_server(address, handler, passwords, workers=0, **kwargs):
+    """Create a server that uses the handler.
+
+    If the handler does not provide passwords itself, they are looked up in
+    the passwords dictionary.
+    """
+    if handler.get_password is RequestHandler.get_password:
+        handler = type(handler.__name__, (_PasswordsMixin, handler), {})
+    if workers:
+        base = PooledReportServer
+        kwargs["workers"] = workers
+    else:
+        base = ReportServer
+    server_class = type("CommandLineServer", (base,), {
+        "handler_class": handler,
+        "handler_klass": handler,
+        "passwords": passwords,
+    })
+    return server_class(address, **kwargs)
+
+
+def _parse_user(value):
+    username, sep, password = value.partition(":")
+    if not sep:
+        raise argparse.ArgumentTypeError("Expected username:password")
+    return username, password
+
+
+def server_main(argv=None):
+    """The rps-server entry point."""
+    parser = argparse.ArgumentParser(
+        description="Run an IP reputation aggregator.")
+    parser.add_argument("--address", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--user", type=_parse_user, action="append",
+                        default=[], metavar="USERNAME:PASSWORD",
+                        help="A user that may send reports (may be given "
+                             "more than once).")
+    parser.add_argument("--handler", type=load_handler, default=PrintHandler,
+                        metavar="MODULE:CLASS",
+                        help="The RequestHandler subclass to use (default: "
+                             "print the events).")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Handle reports on a pool of this many worker "
+                             "threads.")
+    parser.add_argument("--queue-size", type=int)
+    parser.add_argument("--overflow", choices=OVERFLOW_POLICIES)
+    parser.add_argument("--receive-buffer", type=int,
+                        help="The socket receive buffer size, in bytes.")
+    parser.add_argument("--snapshot", metavar="PATH",
+                        help="Save the replay cache here periodically and "
+                             "on shutdown, and restore it on start.")
+    parser.add_argument("--snapshot-interval", type=float, default=60,
+                        help="Seconds between snapshots.")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else
+                        logging.INFO)
+    kwargs = {"receive_buffer": args.receive_buffer,
+              "snapshot_path": args.snapshot}
+    if args.workers:
+        kwargs.update(queue_size=args.queue_size, overflow=args.overflow)
+    server = make_server((args.address, args.port), args.handler,
+                         dict(args.user), args.workers, **kwargs)
+    server.snapshot_interval = args.snapshot_interval
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logging.getLogger("ip-reputation").info(
+            "Processed %d reports (%s dropped before read).",
+            server.report_count, server.dropped_count)
+    return 0
@@ -13,16 +13,24 @@ software version SHOULD be an ASCII string, but in this implementation it
 MUST be an ASCII string.
 """
 
+import os
+import sys
 import time
 import hmac
 import struct
+import queue
 import random
 import socket
 import hashlib
 import logging
 import ipaddress
+import threading
 import socketserver
 
+from rps.snapshot import SnapshotError
+from rps.snapshot import read_snapshot
+from rps.snapshot import write_snapshot
+
 try:
     import spoon
     import spoon.server
@@ -36,6 +44,16 @@ else:
 PORT = 6568
 VERSION = 2
 
+# What PooledReportServer does with a datagram when its queue is full.
+DROP_NEWEST = "drop-newest"
+DROP_OLDEST = "drop-oldest"
+BLOCK = "block"
+OVERFLOW_POLICIES = (DROP_NEWEST, DROP_OLDEST, BLOCK)
+
+# The Linux files that list UDP sockets, including a per-socket count of
+# datagrams dropped because the receive buffer was full.
+PROC_NET_UDP = ("/proc/net/udp", "/proc/net/udp6")
+
 EVENTS = [
     # Event type 0 is reserved. A sensor MUST NOT report events of type 0.
     "RESERVED",
@@ -208,6 +226,32 @@ def reportable_ip(address):
     assert not address.is_reserved
 
 
+def read_socket_drops(sock, paths=PROC_NET_UDP):
+    """Return the number of datagrams the kernel has dropped for the socket
+    (because its receive buffer was full), and the number of bytes that are
+    currently waiting in the receive buffer.
+
+    This is only available on Linux; elsewhere, (None, None) is returned.
+    """
+    inode = str(os.fstat(sock.fileno()).st_ino)
+    for path in paths:
+        try:
+            with open(path) as proc_file:
+                lines = proc_file.readlines()[1:]
+        except (IOError, OSError):
+            continue
+        for line in lines:
+            fields = line.split()
+            # The fields are: sl, local_address, rem_address, st,
+            # tx_queue:rx_queue, tr:tm->when, retrnsmt, uid, timeout,
+            # inode, ref, pointer, drops.
+            if len(fields) < 13 or fields[9] != inode:
+                continue
+            rx_queue = int(fields[4].split(":")[1], 16)
+            return int(fields[12]), rx_queue
+    return None, None
+
+
 class RequestHandler(_handler_parent):
     """Handle a single request.
 
@@ -236,20 +280,24 @@ class RequestHandler(_handler_parent):
         report, footer = report[:-10], report[-10:]
         signature_text = report
         try:
-            (version, username_length,
-             report) = report[0], report[1], report[2:]
-        except IndexError:
+            version, username_length = struct.unpack("!BB", report[:2])
+        except struct.error:
             self.server.log.info("Invalid report (%r) from %s.",
                                  report, self.client_address[0])
             return
-        username_length = ord(username_length)
+        report = report[2:]
         username, report = (report[:username_length],
                             report[username_length:])
-        username = struct.unpack("!%ss" % username_length,
-                                 username)[0].decode("utf8")
+        try:
+            username = struct.unpack("!%ss" % username_length,
+                                     username)[0].decode("utf8")
+        except (struct.error, UnicodeDecodeError):
+            self.server.log.info("Invalid username (%r) from %s.",
+                                 username, self.client_address[0])
+            return
         # An aggregator must ignore a report with a version number other
         # than 2.
-        if version != "\x02":
+        if version != VERSION:
             self.server.log.error("Unknown version: %s", version)
             return
         # The aggregator must look up the secret based on the user name in
@@ -259,6 +307,8 @@ class RequestHandler(_handler_parent):
         if not password:
             self.server.log.debug("No password found.")
             return
+        if not isinstance(password, bytes):
+            password = password.encode("ascii")
         correct_digest = hmac.new(password, signature_text, hashlib.sha1)
         if correct_digest.digest()[:10] != footer:
             self.server.log.info(
@@ -281,28 +331,35 @@ class RequestHandler(_handler_parent):
                 "Report too old: %s vs. %s", time.time(), timestamp)
             return
         # An aggregator should use the time stamp and random-number fields
-        # to detect duplicate reports and fend off replay attacks.
-        if (timestamp, random8) in self.server.recent_reports:
-            self.server.log.info("Replayed report: %s/%s", timestamp, random8)
-            return
-        # Clear out out reports.
-        if random.random() > 0.99:
-            self.server.log.info("Clearing out old reports (current size: %s)",
-                                 len(self.server.recent_reports))
-            for (old_timestamp,
-                 old_random8) in tuple(self.server.recent_reports):
-                if time.time() - old_timestamp > 120:
-                    self.server.log.debug(
-                        "Removing report %s/%s.", old_timestamp, old_random8
-                    )
-                    try:
-                        self.server.recent_reports.remove((old_timestamp,
-                                                           old_random8))
-                    except KeyError:
-                        pass
-            self.server.log.info("Clearing out complete (current size: %s)",
-                                 len(self.server.recent_reports))
-        self.server.recent_reports.add((timestamp, random8))
+        # to detect duplicate reports and fend off replay attacks.  The
+        # check and the update must be atomic, because reports may be
+        # handled by several threads at once.
+        with self.server.state_lock:
+            if (timestamp, random8) in self.server.recent_reports:
+                self.server.log.info("Replayed report: %s/%s", timestamp,
+                                     random8)
+                return
+            # Clear out out reports.
+            if random.random() > 0.99:
+                self.server.log.info(
+                    "Clearing out old reports (current size: %s)",
+                    len(self.server.recent_reports))
+                for (old_timestamp,
+                     old_random8) in tuple(self.server.recent_reports):
+                    if time.time() - old_timestamp > 120:
+                        self.server.log.debug(
+                            "Removing report %s/%s.", old_timestamp,
+                            old_random8
+                        )
+                        try:
+                            self.server.recent_reports.remove(
+                                (old_timestamp, old_random8))
+                        except KeyError:
+                            pass
+                self.server.log.info(
+                    "Clearing out complete (current size: %s)",
+                    len(self.server.recent_reports))
+            self.server.recent_reports.add((timestamp, random8))
         events = []
         try:
             (software_name, software_version,
@@ -323,11 +380,13 @@ class RequestHandler(_handler_parent):
             return
         self.handle_events(username, events, software_name,
                            software_version, end_user)
-        self.server.report_count += 1
-        if self.server.report_count % 1000 == 0:
+        with self.server.state_lock:
+            self.server.report_count += 1
+            report_count = self.server.report_count
+        if report_count % 1000 == 0:
             self.server.log.info(
-                "Processed %d reports since start.",
-                self.server.report_count
+                "Processed %d reports since start (%s dropped before read).",
+                report_count, self.server.dropped_count
             )
 
     def process_subreports(self, subreports, events, software_name=None,
@@ -356,9 +415,18 @@ class RequestHandler(_handler_parent):
                                            end_user)
         # An aggregator must ignore the entire report if any subreports have
         # invalid lengths.
+        assert len(subreports) >= length, "Truncated subreport"
         if report_class in (IPv4Events, RepeatedIPv4Events, IPv6Events,
                             RepeatedIPv6Events):
             assert length % report_class.length == 0
+            # The event type is the last byte of each event, or the second
+            # last for repeated events.
+            offset = report_class.length - 1
+            if report_class in (RepeatedIPv4Events, RepeatedIPv6Events):
+                offset -= 1
+            event_types = subreports[offset:length:report_class.length]
+            assert not event_types or max(event_types) < len(EVENTS), \
+                "Unknown event type"
         elif report_class in (StringReport, SoftwareName, SoftwareVersion, EndUser):
             assert length < report_class.maximum_length
         else:
@@ -373,7 +441,7 @@ class RequestHandler(_handler_parent):
             end_user = subreport.value
         else:
             events.extend(subreport.events)
-        if subreports and subreports != "\x00":
+        if subreports and subreports != b"\x00":
             (software_name, software_version,
              end_user) = self.process_subreports(subreports, events,
                                                  software_name,
@@ -382,18 +450,284 @@ class RequestHandler(_handler_parent):
 
 
 class ReportServer(_server_parent):
-    """A simple server that handles reports."""
+    """A simple server that handles reports.
+
+    If receive_buffer is set, the socket's SO_RCVBUF is set to that many
+    bytes.  The number of datagrams that the kernel dropped before they
+    could be read (because the receive buffer was full) is sampled into
+    dropped_count, which is None if the platform does not provide it.
+    While serve_forever() runs, this is done every drop_sample_interval
+    seconds by a separate thread (if the interval is not zero), because
+    reading /proc/net/udp on a busy host would delay reading from the
+    socket.
+
+    If snapshot_path is set, the replay cache and the state returned by
+    dump_state() are written there every snapshot_interval seconds (by a
+    separate thread, so that the file I/O does not delay reading from the
+    socket) and when the server is closed.  They are restored from there
+    (with load_state()) when serve_forever() is first called; servers that
+    handle requests some other way should call restore_snapshot() before
+    the first one.
+    """
     # handler_class is used for SocketServer, and handler_klass is used
     # for spoon.server. For compatibility, it's easiest to just have
     # them both defined.
     server_logger = "ip-reputation"
     handler_class = RequestHandler
     handler_klass = RequestHandler
-
-    def __init__(self, address):
+    # The largest UDP datagram, so that reports are never truncated (the
+    # socketserver default is 8192 bytes).
+    max_packet_size = 65535
+    receive_buffer = None
+    drop_sample_interval = 10
+    snapshot_path = None
+    snapshot_interval = 60
+
+    def __init__(self, address, receive_buffer=None, snapshot_path=None):
         self.recent_reports = set()
         self.report_count = 0
+        # Protects recent_reports and report_count, and is held while
+        # dump_state() and load_state() are called.
+        self.state_lock = threading.RLock()
+        if receive_buffer is not None:
+            self.receive_buffer = receive_buffer
+        self.receive_buffer_size = None
+        self.dropped_count = None
+        self.receive_queue = None
+        if snapshot_path is not None:
+            self.snapshot_path = snapshot_path
+        self.snapshot_restored = False
+        self.snapshot_thread = None
+        self.drop_sample_thread = None
+        # Set when the server is closed, to stop the background threads.
+        self.closing = threading.Event()
         super(ReportServer, self).__init__(address)
+        self.sample_drops()
+
+    def server_bind(self):
+        """Set the size of the receive buffer before binding."""
+        if self.receive_buffer:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                   self.receive_buffer)
+            # Linux doubles the requested value (to allow for bookkeeping
+            # overhead), but caps the request at net.core.rmem_max, so a
+            # capped request reads back as less than double.
+            self.receive_buffer_size = self.socket.getsockopt(
+                socket.SOL_SOCKET, socket.SO_RCVBUF)
+            expected = self.receive_buffer
+            if sys.platform.startswith("linux"):
+                expected *= 2
+            if self.receive_buffer_size < expected:
+                logging.getLogger(self.server_logger).warning(
+                    "Requested a receive buffer of %d bytes, but the kernel "
+                    "only allowed %d (check net.core.rmem_max).",
+                    self.receive_buffer, self.receive_buffer_size)
+        super(ReportServer, self).server_bind()
+
+    def sample_drops(self):
+        """Update dropped_count and receive_queue from the kernel, and
+        return dropped_count."""
+        dropped_count, self.receive_queue = read_socket_drops(self.socket)
+        if (dropped_count is not None and self.dropped_count is not None and
+                dropped_count > self.dropped_count):
+            self.log.warning(
+                "Kernel dropped %d datagrams before they were read "
+                "(%d since start, %s bytes queued).",
+                dropped_count - self.dropped_count, dropped_count,
+                self.receive_queue)
+        self.dropped_count = dropped_count
+        return dropped_count
+
+    def sample_drops_periodically(self):
+        """Sample drops every drop_sample_interval seconds, until the
+        server is closed.  This runs on the drop sampling thread."""
+        while not self.closing.wait(self.drop_sample_interval):
+            self.sample_drops()
+
+    def _start_thread(self, target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def serve_forever(self, *args, **kwargs):
+        """Restore the snapshot (after any subclass has finished setting
+        up its state), and start sampling drops and writing snapshots,
+        then handle requests until shutdown()."""
+        if self.snapshot_path and not self.snapshot_restored:
+            self.restore_snapshot()
+        if self.drop_sample_interval and self.drop_sample_thread is None:
+            self.drop_sample_thread = self._start_thread(
+                self.sample_drops_periodically)
+        if self.snapshot_path and self.snapshot_thread is None:
+            self.snapshot_thread = self._start_thread(self.write_snapshots)
+        super(ReportServer, self).serve_forever(*args, **kwargs)
+
+    def dump_state(self):
+        """Subclasses that keep state (for example, aggregated events)
+        should override, returning it as bytes to include in snapshots.
+
+        This is called from the snapshot thread while handlers are running
+        (on several worker threads with PooledReportServer), so it must be
+        thread-safe.  It is called with state_lock held, so holding
+        state_lock while updating the state is enough; it should only copy
+        the state, because no reports can be accepted meanwhile.
+        """
+        return b""
+
+    def load_state(self, state):
+        """Subclasses that override dump_state() should override, restoring
+        the state from the bytes in a snapshot.
+
+        Like dump_state(), this is called with state_lock held, and must
+        be thread-safe, because PooledReportServer workers are already
+        running.
+        """
+        pass
+
+    def write_snapshots(self):
+        """Write a snapshot every snapshot_interval seconds, until the
+        server is closed.  This runs on the snapshot thread."""
+        while not self.closing.wait(self.snapshot_interval):
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        """Write the replay cache and state to snapshot_path."""
+        with self.state_lock:
+            recent_reports = tuple(self.recent_reports)
+            state = self.dump_state()
+        try:
+            write_snapshot(self.snapshot_path, recent_reports, state)
+        except (IOError, OSError) as e:
+            self.log.error("Unable to write snapshot: %s", e)
+            return
+        self.log.debug("Wrote snapshot of %d reports to %s",
+                       len(recent_reports), self.snapshot_path)
+
+    def restore_snapshot(self):
+        """Restore the replay cache and state from snapshot_path, if it
+        exists."""
+        self.snapshot_restored = True
+        if not os.path.exists(self.snapshot_path):
+            return
+        try:
+            recent_reports, state = read_snapshot(self.snapshot_path)
+        except (IOError, OSError, SnapshotError) as e:
+            self.log.error("Unable to read snapshot: %s", e)
+            return
+        with self.state_lock:
+            self.recent_reports.update(recent_reports)
+            self.load_state(state)
+        self.log.info("Restored snapshot of %d reports from %s",
+                      len(recent_reports), self.snapshot_path)
+
+    def server_close(self):
+        """Stop the background threads and write a final snapshot, then
+        close the server."""
+        self.closing.set()
+        for thread in (self.drop_sample_thread, self.snapshot_thread):
+            if thread is not None:
+                thread.join()
+        self.drop_sample_thread = self.snapshot_thread = None
+        # A server that never restored the snapshot would replace it with
+        # empty state.
+        if self.snapshot_path and self.snapshot_restored:
+            self.write_snapshot()
+        super(ReportServer, self).server_close()
+
+
+class PooledReportServer(ReportServer):
+    """A server that receives reports on one thread, and handles them on
+    a pool of worker threads.
+
+    The thread that calls serve_forever() only reads datagrams and puts
+    them in a bounded queue, so a slow handle_events() does not stop the
+    server from reading from the socket.  When the queue is full, the
+    overflow policy decides what happens:
+
+        * DROP_NEWEST: the datagram that was just received is dropped.
+        * DROP_OLDEST: the oldest queued datagram is dropped.
+        * BLOCK: the receiver waits until there is space in the queue
+          (and the kernel drops datagrams instead, if its buffer fills).
+
+    The number of times each policy was applied is kept in
+    overflow_counts.
+    """
+    workers = 4
+    queue_size = 1024
+    overflow = DROP_NEWEST
+
+    def __init__(self, address, workers=None, queue_size=None,
+                 overflow=None, **kwargs):
+        if workers is not None:
+            self.workers = workers
+        if queue_size is not None:
+            self.queue_size = queue_size
+        if overflow is not None:
+            self.overflow = overflow
+        assert self.overflow in OVERFLOW_POLICIES, self.overflow
+        assert self.workers > 0
+        self.queue = queue.Queue(self.queue_size)
+        self.overflow_counts = dict((policy, 0)
+                                    for policy in OVERFLOW_POLICIES)
+        self.worker_threads = []
+        super(PooledReportServer, self).__init__(address, **kwargs)
+        for dummy in range(self.workers):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+            self.worker_threads.append(thread)
+
+    def process_request(self, request, client_address):
+        """Queue the request for a worker, applying the overflow policy
+        if the queue is full."""
+        item = (request, client_address)
+        try:
+            self.queue.put_nowait(item)
+            return
+        except queue.Full:
+            self.overflow_counts[self.overflow] += 1
+        if self.overflow == BLOCK:
+            self.queue.put(item)
+        elif self.overflow == DROP_OLDEST:
+            while True:
+                try:
+                    dropped = self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+                else:
+                    self.shutdown_request(dropped[0])
+                try:
+                    self.queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    pass
+        else:
+            self.shutdown_request(request)
+
+    def work(self):
+        """Handle queued requests until a None is taken from the queue."""
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        """Let the workers finish handling the queued requests, then close
+        the server."""
+        for dummy in self.worker_threads:
+            self.queue.put(None)
+        for thread in self.worker_threads:
+            thread.join()
+        self.worker_threads = []
+        super(PooledReportServer, self).server_close()
 
 
 class SubReport(object):
@@ -465,7 +799,7 @@ class IPEvent(object):
     def from_bytes(cls, bytestr):
         """Return an instance of this class with the data from the given
         byte string."""
-        event = EVENTS[struct.unpack("B", bytestr[-1])[0]]
+        event = EVENTS[struct.unpack("B", bytestr[-1:])[0]]
         bytestr = bytestr[:-1]
         fmt = "!" + ("B" * len(bytestr))
         parts = enumerate(struct.unpack(fmt, bytestr)[::-1])
@@ -561,8 +895,8 @@ class RepeatedIPEvent(IPEvent):
     def from_bytes(cls, bytestr):
         """Return an instance of this class with the data from the given
         byte string."""
-        event = EVENTS[struct.unpack("B", bytestr[-1])[0]]
-        repeat = EVENTS[struct.unpack("B", bytestr[-2])[0]]
+        event = EVENTS[struct.unpack("B", bytestr[-2:-1])[0]]
+        repeat = struct.unpack("B", bytestr[-1:])[0]
         bytestr = bytestr[:-2]
         fmt = "!" + ("B" * len(bytestr))
 
@@ -629,7 +963,7 @@ class RepeatedIPv6Events(RepeatedEvents):
           It must be greater than or equal to two.
     """
     format = 4
-    repeat = 18
+    length = 18
 
 
 class StringReport(SubReport):
@@ -656,7 +990,10 @@ class StringReport(SubReport):
     def from_bytes(cls, bytestr):
         """Return an instance of this class with the data from the given
         byte string."""
-        return cls(struct.unpack("%ss" % len(bytestr), bytestr)[0])
+        value = struct.unpack("%ss" % len(bytestr), bytestr)[0]
+        if cls.encoding:
+            value = value.decode(cls.encoding)
+        return cls(value)
 
 
 class SoftwareName(StringReport):
@@ -701,6 +1038,3 @@ class EndUser(StringReport):
 FORMATS = dict((obj.format, obj) for obj in locals().values()
                if isinstance(obj, type) and issubclass(obj, SubReport) and
                obj.format is not None)
-
-# XXX We could add a simple script that can report event CLI.
-# XXX This will also allow for functional tests.
@@ -0,0 +1,371 @@
+"""Fixed-memory streaming detection of the heaviest reporters.
+
+Counting every address exactly takes memory proportional to the number
+of distinct addresses, which is unbounded during a botnet wave.  Instead,
+HeavyHitters keeps, for each event type, a Count-Min sketch (for estimated
+counts of any address) and a Space-Saving summary (for the top-K
+addresses).  Both use a fixed amount of memory, and both can be merged,
+so that sketches kept by several workers or servers can be combined.
+
+TumblingWindow and SlidingWindow keep HeavyHitters over time windows, and
+HeavyHitterHandler feeds one from the events that a server receives:
+
+    class Server(ReportServer):
+        handler_class = HeavyHitterHandler
+        handler_klass = HeavyHitterHandler
+
+    server = Server(address)
+    server.heavy_hitters = SlidingWindow(3600, 12)
+    ...
+    server.heavy_hitters.top("AUTO-SPAM", 10)
+"""
+
+import time
+import array
+import heapq
+import struct
+import operator
+import hashlib
+import ipaddress
+import threading
+
+from rps.report import RequestHandler
+
+
+class CountMinSketch(object):
+    """Estimated counts of keys, in depth * width counters.
+
+    An estimate is never lower than the true count, and with probability
+    1 - (1/2) ** depth it is at most 2 / width * the total count higher.
+    Sketches can only be merged if they have the same width, depth and
+    seed.
+    """
+
+    def __init__(self, width=2048, depth=4, seed=0):
+        self.width = width
+        self.depth = depth
+        self.seed = seed
+        self.total = 0
+        self._key = struct.pack("!Q", seed)
+        self.rows = [array.array("Q", bytes(8 * width))
+                     for dummy in range(depth)]
+
+    def _indexes(self, key):
+        # Derive all the row hashes from one 128-bit hash (Kirsch and
+        # Mitzenmacher's double hashing).
+        digest = hashlib.blake2b(key, digest_size=16, key=self._key).digest()
+        first, second = struct.unpack("!QQ", digest)
+        return [(first + row * second) % self.width
+                for row in range(self.depth)]
+
+    def add(self, key, count=1):
+        """Add count to the key (which must be bytes), and return the new
+        estimate."""
+        self.total += count
+        estimate = None
+        for row, index in zip(self.rows, self._indexes(key)):
+            row[index] += count
+            if estimate is None or row[index] < estimate:
+                estimate = row[index]
+        return estimate
+
+    def estimate(self, key):
+        return min(row[index]
+                   for row, index in zip(self.rows, self._indexes(key)))
+
+    def copy(self):
+        result = type(self)(self.width, self.depth, self.seed)
+        result.total = self.total
+        result.rows = [array.array("Q", row) for row in self.rows]
+        return result
+
+    def merge(self, other):
+        """Add the counts of the other sketch to this one."""
+        assert (self.width, self.depth, self.seed) == (
+            other.width, other.depth, other.seed), "Incompatible sketches"
+        self.total += other.total
+        for row, other_row in zip(self.rows, other.rows):
+            row[:] = array.array("Q", map(operator.add, row, other_row))
+
+
+class SpaceSaving(object):
+    """The (approximately) k most frequent keys.
+
+    Each monitored key has a count, which is never lower than its true
+    count, and an error, which is the most that the count may be too high.
+    Any key with a true count over total / k is guaranteed to be monitored.
+    """
+
+    def __init__(self, k=100):
+        self.k = k
+        self.total = 0
+        self.counts = {}
+        self.errors = {}
+        # A min-heap of (count, key).  Counts in the heap may be lower than
+        # the real count, which is fixed up lazily when looking for the
+        # minimum.
+        self._heap = []
+
+    def _pop_minimum(self):
+        while True:
+            count, key = heapq.heappop(self._heap)
+            if self.counts[key] == count:
+                return count, key
+            heapq.heappush(self._heap, (self.counts[key], key))
+
+    def add(self, key, count=1):
+        self.total += count
+        if key in self.counts:
+            self.counts[key] += count
+            return
+        if len(self.counts) < self.k:
+            self.counts[key] = count
+            self.errors[key] = 0
+            heapq.heappush(self._heap, (count, key))
+            return
+        # Replace the key with the lowest count; the new key might have
+        # been seen that many times before.
+        minimum, evicted = self._pop_minimum()
+        del self.counts[evicted]
+        del self.errors[evicted]
+        self.counts[key] = minimum + count
+        self.errors[key] = minimum
+        heapq.heappush(self._heap, (minimum + count, key))
+
+    def copy(self):
+        result = type(self)(self.k)
+        result.total = self.total
+        result.counts = dict(self.counts)
+        result.errors = dict(self.errors)
+        result._heap = list(self._heap)
+        return result
+
+    def minimum(self):
+        """Return the highest count that an unmonitored key may have."""
+        if len(self.counts) < self.k:
+            return 0
+        return min(self.counts.values())
+
+    def top(self, n=None):
+        """Return a list of (key, count, error) tuples of the n keys with
+        the highest counts, highest first."""
+        keys = heapq.nlargest(n or self.k, self.counts, key=self.counts.get)
+        return [(key, self.counts[key], self.errors[key]) for key in keys]
+
+    def merge(self, other):
+        """Add the other summary's keys to this one, keeping the top k.
+
+        A key that one of the summaries does not monitor may have been
+        seen up to that summary's minimum() times, which is added to both
+        its count and its error (Agarwal et al., "Mergeable Summaries").
+        """
+        own_minimum, other_minimum = self.minimum(), other.minimum()
+        counts, errors = {}, {}
+        for key in set(self.counts) | set(other.counts):
+            counts[key] = (self.counts.get(key, own_minimum) +
+                           other.counts.get(key, other_minimum))
+            errors[key] = (self.errors.get(key, own_minimum) +
+                           other.errors.get(key, other_minimum))
+        keep = heapq.nlargest(self.k, counts, key=counts.get)
+        self.total += other.total
+        self.counts = dict((key, counts[key]) for key in keep)
+        self.errors = dict((key, errors[key]) for key in keep)
+        self._heap = [(count, key) for key, count in self.counts.items()]
+        heapq.heapify(self._heap)
+
+
+class HeavyHitters(object):
+    """A Count-Min sketch and Space-Saving summary for each event type."""
+
+    def __init__(self, k=100, width=2048, depth=4, seed=0):
+        self.k = k
+        self.width = width
+        self.depth = depth
+        self.seed = seed
+        self.sketches = {}
+        self.summaries = {}
+
+    def copy_empty(self):
+        """Return an empty HeavyHitters that can be merged with this."""
+        return type(self)(self.k, self.width, self.depth, self.seed)
+
+    def copy(self, event=None):
+        """Return a copy of this, with only the given event type if it is
+        not None."""
+        result = self.copy_empty()
+        for key in self._events(event):
+            result.sketches[key] = self.sketches[key].copy()
+            result.summaries[key] = self.summaries[key].copy()
+        return result
+
+    def _events(self, event):
+        if event is None:
+            return list(self.sketches)
+        return [event] if event in self.sketches else []
+
+    def _get(self, event):
+        try:
+            return self.sketches[event], self.summaries[event]
+        except KeyError:
+            sketch = self.sketches[event] = CountMinSketch(
+                self.width, self.depth, self.seed)
+            summary = self.summaries[event] = SpaceSaving(self.k)
+            return sketch, summary
+
+    def add(self, address, event, count=1):
+        """Count an event from the address (an ipaddress object)."""
+        sketch, summary = self._get(event)
+        key = address.packed
+        sketch.add(key, count)
+        summary.add(key, count)
+
+    def add_events(self, events):
+        """Count a list of events, as passed to handle_events()."""
+        for event in events:
+            self.add(event.address, event.event,
+                     getattr(event, "repeat", 1))
+
+    def estimate(self, address, event):
+        """Return the estimated count of the event from the address."""
+        try:
+            sketch = self.sketches[event]
+        except KeyError:
+            return 0
+        return sketch.estimate(ipaddress.ip_address(address).packed)
+
+    def top(self, event, n=10):
+        """Return a list of (address, estimated count) tuples for the n
+        addresses with the most events of this type, highest first."""
+        try:
+            summary = self.summaries[event]
+        except KeyError:
+            return []
+        sketch = self.sketches[event]
+        # Both structures overestimate, so the lower is the better bound.
+        return [(ipaddress.ip_address(key), min(count, sketch.estimate(key)))
+                for key, count, dummy in summary.top(n)]
+
+    def merge(self, other, event=None):
+        """Add the counts in other to this, for only the given event type
+        if it is not None."""
+        for key in other._events(event):
+            sketch, summary = self._get(key)
+            sketch.merge(other.sketches[key])
+            summary.merge(other.summaries[key])
+
+
+class TumblingWindow(object):
+    """HeavyHitters over consecutive, non-overlapping windows of length
+    seconds.
+
+    Queries are for the current window, unless complete is true, in which
+    case they are for the last complete window.
+    """
+
+    def __init__(self, length, heavy_hitters=None, clock=time.time):
+        self.length = length
+        self.clock = clock
+        self.current = heavy_hitters or HeavyHitters()
+        self.previous = self.current.copy_empty()
+        self.start = self.clock() // length * length
+        self.lock = threading.Lock()
+
+    def _rotate(self):
+        start = self.clock() // self.length * self.length
+        if start == self.start:
+            return
+        if start - self.start == self.length:
+            self.previous = self.current
+        else:
+            # Nothing was added during the last complete window.
+            self.previous = self.current.copy_empty()
+        self.current = self.current.copy_empty()
+        self.start = start
+
+    def add_events(self, events):
+        with self.lock:
+            self._rotate()
+            self.current.add_events(events)
+
+    def _window(self, complete):
+        # Must be called with the lock held, which must then be kept while
+        # querying, because add_events() may evict keys from the current
+        # window's summaries.
+        self._rotate()
+        return self.previous if complete else self.current
+
+    def estimate(self, address, event, complete=False):
+        with self.lock:
+            return self._window(complete).estimate(address, event)
+
+    def top(self, event, n=10, complete=False):
+        with self.lock:
+            return self._window(complete).top(event, n)
+
+
+class SlidingWindow(object):
+    """HeavyHitters over the last length seconds.
+
+    The window is split into buckets, each with its own HeavyHitters, so
+    the window slides in steps of length / buckets seconds and takes
+    buckets times the memory of one HeavyHitters.  Queries merge the
+    buckets for the event type being queried.  Only the newest bucket is
+    added to, so only that is copied while holding the lock, and the
+    merging is done without it.
+    """
+
+    def __init__(self, length, buckets=6, heavy_hitters=None,
+                 clock=time.time):
+        self.step = float(length) / buckets
+        self.clock = clock
+        self.template = heavy_hitters or HeavyHitters()
+        # A list of (bucket number, HeavyHitters), oldest first.
+        self.buckets = []
+        self.bucket_count = buckets
+        self.lock = threading.Lock()
+
+    def _expire(self, number):
+        oldest = number - self.bucket_count
+        while self.buckets and self.buckets[0][0] <= oldest:
+            self.buckets.pop(0)
+
+    def add_events(self, events):
+        with self.lock:
+            number = int(self.clock() // self.step)
+            self._expire(number)
+            if not self.buckets or self.buckets[-1][0] != number:
+                self.buckets.append((number, self.template.copy_empty()))
+            self.buckets[-1][1].add_events(events)
+
+    def merged(self, event=None):
+        """Return a HeavyHitters for the whole window, with only the given
+        event type if it is not None."""
+        with self.lock:
+            self._expire(int(self.clock() // self.step))
+            buckets = [heavy_hitters for dummy, heavy_hitters in
+                       self.buckets[:-1]]
+            if self.buckets:
+                buckets.append(self.buckets[-1][1].copy(event))
+        result = self.template.copy_empty()
+        for heavy_hitters in buckets:
+            result.merge(heavy_hitters, event)
+        return result
+
+    def estimate(self, address, event):
+        return self.merged(event).estimate(address, event)
+
+    def top(self, event, n=10):
+        return self.merged(event).top(event, n)
+
+
+class HeavyHitterHandler(RequestHandler):
+    """Count the events in every report in the server's heavy_hitters,
+    which can be a HeavyHitters, TumblingWindow or SlidingWindow.
+
+    A plain HeavyHitters is not thread-safe, so should only be used with a
+    single-threaded server.
+    """
+
+    def handle_events(self, username, events, software_name,
+                      software_version, end_user):
+        self.server.heavy_hitters.add_events(events)
@@ -0,0 +1,113 @@
+"""Snapshots of aggregator state, for warm restarts.
+
+A snapshot holds the replay cache (ReportServer.recent_reports) and an
+opaque blob of handler state.  The file format is:
+
+    * A 24-byte header: the magic "RPSS", a one-byte format version, three
+      padding bytes, the time the snapshot was written (a double), the
+      number of replay cache entries, and the length of the handler state
+      (both four-byte unsigned integers).
+    * The replay cache entries, each a four-byte timestamp followed by the
+      eight random bytes of the report.
+    * The handler state.
+    * A four-byte CRC32 of everything before it.
+
+All integers are in network byte order.  Snapshots are written to a
+temporary file which is then renamed, so a reader never sees a partially
+written snapshot, and are read back with mmap.
+"""
+
+import os
+import mmap
+import time
+import zlib
+import struct
+import tempfile
+
+MAGIC = b"RPSS"
+FORMAT_VERSION = 1
+
+_HEADER = struct.Struct("!4sBxxxdII")
+_ENTRY = struct.Struct("!I8s")
+_CRC = struct.Struct("!I")
+
+
+class SnapshotError(ValueError):
+    """A snapshot file is invalid."""
+
+
+def write_snapshot(path, recent_reports, state=b"", max_age=120):
+    """Atomically write the recent_reports (timestamp, random bytes) pairs,
+    and the handler state bytes, to path.
+
+    Entries more than max_age seconds old are left out, because they can
+    no longer be replayed.
+    """
+    now = time.time()
+    entries = [(timestamp, random8) for timestamp, random8 in recent_reports
+               if now - timestamp <= max_age]
+    data = bytearray(_HEADER.pack(MAGIC, FORMAT_VERSION, now, len(entries),
+                                  len(state)))
+    for entry in entries:
+        data += _ENTRY.pack(*entry)
+    data += state
+    data += _CRC.pack(zlib.crc32(data) & 0xffffffff)
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temporary = tempfile.mkstemp(prefix=".snapshot-", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as snapshot:
+            snapshot.write(data)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+    # Make sure that the rename itself is durable.
+    try:
+        directory_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(directory_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(directory_fd)
+
+
+def read_snapshot(path, max_age=120):
+    """Read a snapshot, and return a set of (timestamp, random bytes) pairs
+    for the replay cache, and the handler state bytes.
+
+    Entries that are now more than max_age seconds old are dropped.  Raise
+    SnapshotError if the file is not a valid snapshot.
+    """
+    with open(path, "rb") as snapshot:
+        size = os.fstat(snapshot.fileno()).st_size
+        if size < _HEADER.size + _CRC.size:
+            raise SnapshotError("Snapshot is too short: %d bytes" % size)
+        mapped = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapped)
+    try:
+        magic, version, dummy, count, state_length = _HEADER.unpack_from(
+            view)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise SnapshotError("Not a version %d snapshot" % FORMAT_VERSION)
+        entries_end = _HEADER.size + count * _ENTRY.size
+        state_end = entries_end + state_length
+        if state_end + _CRC.size != size:
+            raise SnapshotError("Snapshot has the wrong size")
+        crc = _CRC.unpack_from(view, state_end)[0]
+        if zlib.crc32(view[:state_end]) & 0xffffffff != crc:
+            raise SnapshotError("Snapshot checksum does not match")
+        now = time.time()
+        recent_reports = set(
+            entry for entry in _ENTRY.iter_unpack(
+                view[_HEADER.size:entries_end])
+            if now - entry[0] <= max_age)
+        state = bytes(view[entries_end:state_end])
+    finally:
+        view.release()
+        mapped.close()
+    return recent_reports, state
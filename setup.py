@@ -30,6 +30,12 @@ setup(
     keywords='spam',
     classifiers=CLASSIFIERS,
     # scripts=[],
+    entry_points={
+        "console_scripts": [
+            "rps-report = rps.cli:report_main",
+            "rps-server = rps.cli:server_main",
+        ],
+    },
     requires=REQUIRES,
     packages=[
         'rps',
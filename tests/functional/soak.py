@@ -0,0 +1,457 @@
+#! /usr/bin/env python
+
+"""A long-running soak test of ReportServer.
+
+A ReportServer is started on the loopback interface, and a set of
+ReportClient senders send a mix of valid, replayed, stale, bad-HMAC and
+malformed (correctly signed, but with a bad subreport) reports to it for
+the configured duration.  While this runs, the RSS of the process, the
+memory traced by tracemalloc (and the top allocators), the size of
+recent_reports and the time taken to handle each report are sampled.
+
+The soak fails if the memory growth or handle latency budgets are
+exceeded.  For example:
+
+    python -m tests.functional.soak --duration 3600 --warmup 300
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import hmac
+import random
+import struct
+import hashlib
+import argparse
+import resource
+import threading
+import collections
+import tracemalloc
+
+from rps.report import IPEvent
+from rps.report import IPv4Events
+from rps.report import EndOfReport
+from rps.report import ReportClient
+from rps.report import ReportServer
+from rps.report import SoftwareName
+from rps.report import RequestHandler
+from rps.report import RepeatedIPEvent
+from rps.report import RepeatedIPv4Events
+from rps.report import PooledReportServer
+from rps.report import OVERFLOW_POLICIES
+
+USERNAME = "soak"
+PASSWORD = "soak-password"
+
+# The default mix of traffic, as relative weights.
+DEFAULT_MIX = {
+    "valid": 80,
+    "replayed": 5,
+    "stale": 5,
+    "bad-hmac": 5,
+    "malformed": 5,
+}
+
+# Only the most recent handle latencies are kept, so that the harness
+# does not itself grow without limit.
+MAX_LATENCIES = 100000
+
+# Globally-routable prefixes to draw the reported addresses from.
+_PREFIXES = (5, 31, 46, 62, 77, 93, 95, 185)
+
+
+class SoakHandler(RequestHandler):
+    """Record how long each report takes to handle."""
+
+    def get_password(self, username):
+        return PASSWORD
+
+    def handle_events(self, username, events, software_name,
+                      software_version, end_user):
+        self.server.handle_events(len(events))
+
+    def handle(self):
+        start = time.perf_counter()
+        try:
+            super(SoakHandler, self).handle()
+        finally:
+            self.server.latencies.append(time.perf_counter() - start)
+
+
+class SoakServer(ReportServer):
+    """A ReportServer that keeps track of handle latencies."""
+    handler_class = SoakHandler
+    handler_klass = SoakHandler
+    # The server runs in a thread of the harness, so it should not take
+    # over the signal handlers of the process.
+    signal_reload = None
+    signal_shutdown = None
+
+    def __init__(self, address, **kwargs):
+        self.event_count = 0
+        self.latencies = collections.deque(maxlen=MAX_LATENCIES)
+        super(SoakServer, self).__init__(address, **kwargs)
+
+    def handle_events(self, events):
+        with self.state_lock:
+            self.event_count += events
+
+
+class PooledSoakServer(SoakServer, PooledReportServer):
+    """A PooledReportServer that keeps track of handle latencies."""
+
+
+class Sample(object):
+    """The state of the process at a point during the soak."""
+
+    def __init__(self, elapsed, rss, traced, recent_reports, report_count,
+                 top_allocators):
+        self.elapsed = elapsed
+        self.rss = rss
+        self.traced = traced
+        self.recent_reports = recent_reports
+        self.report_count = report_count
+        self.top_allocators = top_allocators
+
+    def __str__(self):
+        return ("%7.1fs rss=%.1fMiB traced=%.1fMiB recent_reports=%d "
+                "reports=%d" % (self.elapsed, self.rss / 2.0 ** 20,
+                                self.traced / 2.0 ** 20,
+                                self.recent_reports, self.report_count))
+
+
+class SoakResult(object):
+    """The outcome of a soak run."""
+
+    def __init__(self):
+        self.samples = []
+        self.sent = collections.Counter()
+        self.percentiles = {}
+        self.report_count = 0
+        self.event_count = 0
+        self.overflow_counts = {}
+        self.dropped_count = None
+        self.failures = []
+
+    @property
+    def passed(self):
+        return not self.failures
+
+    def summary(self):
+        lines = ["Sent: %s" % ", ".join("%s=%d" % item for item in
+                                        sorted(self.sent.items())),
+                 "Accepted reports: %d (%d events)" % (self.report_count,
+                                                      self.event_count),
+                 "Dropped before read: %s" % self.dropped_count]
+        if self.overflow_counts:
+            lines.append("Queue overflows: %s" % ", ".join(
+                "%s=%d" % item for item in sorted(
+                    self.overflow_counts.items())))
+        lines.extend(str(sample) for sample in self.samples)
+        lines.append("Handle latency: %s" % ", ".join(
+            "p%s=%.3fms" % (percentile, value * 1000)
+            for percentile, value in sorted(self.percentiles.items())))
+        if self.samples:
+            lines.append("Top allocators:")
+            lines.extend("    %s" % stat
+                         for stat in self.samples[-1].top_allocators)
+        lines.extend("FAILED: %s" % failure for failure in self.failures)
+        return "\n".join(lines)
+
+
+def get_rss():
+    """Return the current resident set size of the process, in bytes."""
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        # Not Linux, so fall back to the peak RSS, which is in kilobytes.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return pages * resource.getpagesize()
+
+
+def percentiles(values, wanted=(50, 90, 99)):
+    """Return a dictionary of the wanted percentiles of the values."""
+    values = sorted(values)
+    if not values:
+        return {}
+    return dict((percentile,
+                 values[min(len(values) - 1,
+                            int(len(values) * percentile / 100.0))])
+                for percentile in wanted)
+
+
+def random_address():
+    return "%d.%d.%d.%d" % (random.choice(_PREFIXES), random.randint(0, 255),
+                            random.randint(0, 255), random.randint(1, 254))
+
+
+def valid_report(password=PASSWORD):
+    """Generate a report with a random set of events."""
+    subreports = [
+        IPv4Events([IPEvent(random_address(), "AUTO-SPAM")
+                    for dummy in range(random.randint(1, 50))]),
+        RepeatedIPv4Events([
+            RepeatedIPEvent(random_address(), "INVALID-RECIPIENT",
+                            random.randint(2, 255))
+            for dummy in range(random.randint(1, 20))]),
+        SoftwareName("rps-soak"),
+        EndOfReport(),
+    ]
+    return ReportClient.generate_report(subreports, USERNAME, password)
+
+
+class RawSubreport(object):
+    """Subreport bytes that are sent as they are, even if malformed."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def __bytes__(self):
+        return self.data
+
+
+def _truncated():
+    # The header claims more events than are sent.
+    events = bytes(IPv4Events([IPEvent(random_address(), "AUTO-SPAM")]))
+    return struct.pack("!BH", IPv4Events.format, 5 * 10) + events[3:]
+
+
+def _bad_length():
+    events = bytes(IPv4Events([IPEvent(random_address(), "AUTO-SPAM")]))
+    return struct.pack("!BH", IPv4Events.format, 4) + events[3:7]
+
+
+def _unknown_event():
+    events = bytes(IPv4Events([IPEvent(random_address(), "AUTO-SPAM")]))
+    return events[:-1] + struct.pack("B", 255)
+
+
+def _unknown_format():
+    data = os.urandom(random.randint(0, 50))
+    return struct.pack("!BH", 200, len(data)) + data
+
+
+# RequestHandler ignores reports with any of these subreports, except that
+# it must skip over subreports with an unknown format.
+MALFORMED = {
+    "truncated": _truncated,
+    "bad-length": _bad_length,
+    "unknown-event": _unknown_event,
+    "unknown-format": _unknown_format,
+}
+
+
+def malformed_report(variant, password=PASSWORD):
+    """Generate a correctly signed report with a valid subreport followed
+    by a subreport of the given MALFORMED variant."""
+    subreports = [
+        IPv4Events([IPEvent(random_address(), "AUTO-SPAM")
+                    for dummy in range(random.randint(1, 10))]),
+        RawSubreport(MALFORMED[variant]()),
+        EndOfReport(),
+    ]
+    return ReportClient.generate_report(subreports, USERNAME, password)
+
+
+def stale_report(report, age=600):
+    """Return the report with its timestamp moved into the past, and the
+    HMAC recalculated."""
+    offset = 2 + len(USERNAME) + 8
+    timestamp = struct.pack("!I", int(time.time()) - age)
+    report = report[:offset] + timestamp + report[offset + 4:-10]
+    digest = hmac.new(PASSWORD.encode("ascii"), report, hashlib.sha1)
+    return report + digest.digest()[:10]
+
+
+def _sender(client, rate, mix, stop, sent, lock):
+    """Send reports from the client until stop is set."""
+    kinds = sorted(mix)
+    weights = [mix[kind] for kind in kinds]
+    last_valid = None
+    interval = 1.0 / rate
+    next_send = time.time()
+    while not stop.is_set():
+        kind = random.choices(kinds, weights)[0]
+        if kind == "replayed" and last_valid is None:
+            # There is nothing to replay yet.
+            kind = "valid"
+        if kind == "valid":
+            report = last_valid = valid_report()
+        elif kind == "replayed":
+            report = last_valid
+        elif kind == "stale":
+            report = stale_report(valid_report())
+        elif kind == "bad-hmac":
+            report = valid_report(password="not-" + PASSWORD)
+        else:
+            variant = random.choice(sorted(MALFORMED))
+            report = malformed_report(variant)
+        try:
+            client.socket.sendto(report, (client.server, client.port))
+        except OSError:
+            kind = "failed"
+        with lock:
+            sent[kind] += 1
+            if kind == "malformed":
+                sent["malformed/%s" % variant] += 1
+        next_send += interval
+        delay = next_send - time.time()
+        if delay > 0:
+            stop.wait(delay)
+
+
+def run_soak(duration=60, senders=2, rate=100, mix=None, interval=5,
+             warmup=0, rss_budget=32, traced_budget=16,
+             latency_budget=50, top=10, workers=0, queue_size=1024,
+             overflow=None, receive_buffer=None):
+    """Run a soak, and return a SoakResult.
+
+    The rate is the number of reports per second for each sender.  Memory
+    budgets are in MiB, and are compared with the growth between the first
+    sample after the warmup period and the end of the soak.  The latency
+    budget is for the 99th percentile handle time, in milliseconds; note
+    that tracing allocations makes handling noticeably slower.
+
+    If workers is not zero, a PooledReportServer with that many workers is
+    used instead of a plain ReportServer.  The receive_buffer is passed on
+    to the server.
+    """
+    mix = mix or DEFAULT_MIX
+    result = SoakResult()
+    tracemalloc.start()
+    if workers:
+        server = PooledSoakServer(("127.0.0.1", 0), workers=workers,
+                                  queue_size=queue_size, overflow=overflow,
+                                  receive_buffer=receive_buffer)
+    else:
+        server = SoakServer(("127.0.0.1", 0), receive_buffer=receive_buffer)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    port = server.server_address[1]
+    stop = threading.Event()
+    lock = threading.Lock()
+    threads = []
+    for dummy in range(senders):
+        client = ReportClient(1, "127.0.0.1", USERNAME, PASSWORD, port=port)
+        thread = threading.Thread(target=_sender, args=(
+            client, rate, mix, stop, result.sent, lock))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    start = time.time()
+    baseline = None
+    try:
+        while True:
+            elapsed = time.time() - start
+            snapshot = tracemalloc.take_snapshot()
+            if baseline is None and elapsed >= warmup:
+                baseline = snapshot
+            if baseline is not None:
+                top_allocators = snapshot.compare_to(baseline,
+                                                     "lineno")[:top]
+            else:
+                top_allocators = []
+            result.samples.append(Sample(
+                elapsed, get_rss(), tracemalloc.get_traced_memory()[0],
+                len(server.recent_reports), server.report_count,
+                top_allocators))
+            if elapsed >= duration:
+                break
+            time.sleep(min(interval, max(0, duration - elapsed)))
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        # Allow the server to finish with anything already queued.
+        time.sleep(0.5)
+        server.shutdown()
+        result.dropped_count = server.sample_drops()
+        server.server_close()
+        server_thread.join()
+        tracemalloc.stop()
+    result.report_count = server.report_count
+    result.overflow_counts = getattr(server, "overflow_counts", {})
+    result.event_count = server.event_count
+    result.percentiles = percentiles(server.latencies)
+    measured = [sample for sample in result.samples
+                if sample.elapsed >= warmup]
+    if len(measured) >= 2:
+        first, last = measured[0], measured[-1]
+        rss_growth = (last.rss - first.rss) / 2.0 ** 20
+        if rss_growth > rss_budget:
+            result.failures.append("RSS grew by %.1fMiB (budget %sMiB)" %
+                                   (rss_growth, rss_budget))
+        traced_growth = (last.traced - first.traced) / 2.0 ** 20
+        if traced_growth > traced_budget:
+            result.failures.append(
+                "Traced memory grew by %.1fMiB (budget %sMiB)" %
+                (traced_growth, traced_budget))
+    if not result.report_count:
+        result.failures.append("No reports were accepted.")
+    p99 = result.percentiles.get(99, 0) * 1000
+    if p99 > latency_budget:
+        result.failures.append("p99 handle latency %.3fms (budget %sms)" %
+                               (p99, latency_budget))
+    return result
+
+
+def _parse_mix(value):
+    """Parse a mix like "valid=80,replayed=5"."""
+    mix = {}
+    for item in value.split(","):
+        kind, weight = item.split("=")
+        if kind not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError("Unknown traffic: %s" % kind)
+        mix[kind] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--duration", type=float, default=60,
+                        help="How long to run for, in seconds.")
+    parser.add_argument("--senders", type=int, default=2,
+                        help="The number of ReportClient senders.")
+    parser.add_argument("--rate", type=float, default=100,
+                        help="Reports per second, for each sender.")
+    parser.add_argument("--mix", type=_parse_mix, default=DEFAULT_MIX,
+                        help="Relative weights of each kind of traffic, "
+                             "e.g. valid=80,replayed=5,stale=5,"
+                             "bad-hmac=5,malformed=5")
+    parser.add_argument("--interval", type=float, default=5,
+                        help="Seconds between memory samples.")
+    parser.add_argument("--warmup", type=float, default=0,
+                        help="Seconds before memory growth is measured.")
+    parser.add_argument("--rss-budget", type=float, default=32,
+                        help="Allowed RSS growth, in MiB.")
+    parser.add_argument("--traced-budget", type=float, default=16,
+                        help="Allowed tracemalloc growth, in MiB.")
+    parser.add_argument("--latency-budget", type=float, default=50,
+                        help="Allowed p99 handle latency, in ms.")
+    parser.add_argument("--top", type=int, default=10,
+                        help="The number of top allocators to show.")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Use a PooledReportServer with this many "
+                             "workers.")
+    parser.add_argument("--queue-size", type=int, default=1024,
+                        help="The PooledReportServer queue size.")
+    parser.add_argument("--overflow", choices=OVERFLOW_POLICIES,
+                        help="The PooledReportServer overflow policy.")
+    parser.add_argument("--receive-buffer", type=int,
+                        help="The socket receive buffer size, in bytes.")
+    args = parser.parse_args()
+    result = run_soak(args.duration, args.senders, args.rate, args.mix,
+                      args.interval, args.warmup, args.rss_budget,
+                      args.traced_budget, args.latency_budget, args.top,
+                      args.workers, args.queue_size, args.overflow,
+                      args.receive_buffer)
+    print(result.summary())
+    return 0 if result.passed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,36 @@
+"""A short run of the soak harness.
+
+These only check that the harness runs and that the server accepts the
+right reports.  The memory and latency budgets depend on the machine (and
+three seconds is too short to measure growth), so they are made generous
+here; use the command line harness for a real soak.
+"""
+
+import unittest
+
+from tests.functional.soak import run_soak
+
+# Budgets that a short run on a loaded machine cannot exceed.
+_NO_BUDGETS = {"rss_budget": 1024, "traced_budget": 1024,
+               "latency_budget": 10000}
+
+
+class TestSoak(unittest.TestCase):
+    def check_counts(self, result):
+        self.assertGreater(result.sent["valid"], 0)
+        self.assertGreater(result.event_count, 0)
+        self.assertGreater(result.sent["malformed"], 0)
+        # Only valid reports, and those with subreports of an unknown format
+        # (which are skipped), are accepted; loopback does not drop.
+        self.assertEqual(result.report_count,
+                         result.sent["valid"] +
+                         result.sent["malformed/unknown-format"],
+                         result.summary())
+
+    def test_short_soak(self):
+        self.check_counts(run_soak(duration=3, senders=2, rate=50,
+                                   interval=1, **_NO_BUDGETS))
+
+    def test_short_pooled_soak(self):
+        self.check_counts(run_soak(duration=3, senders=2, rate=50,
+                                   interval=1, workers=4, **_NO_BUDGETS))
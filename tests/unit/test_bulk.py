@@ -0,0 +1,169 @@
+"""Test rps.bulk"""
+
+import hmac
+import hashlib
+import unittest
+
+import mock
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from rps.bulk import decode_reports
+from rps.report import EVENTS
+from rps.report import IPEvent
+from rps.report import IPv4Events
+from rps.report import IPv6Events
+from rps.report import EndOfReport
+from rps.report import ReportClient
+from rps.report import SoftwareName
+from rps.report import RepeatedIPEvent
+from rps.report import RepeatedIPv4Events
+from rps.report import RepeatedIPv6Events
+
+
+class TestDecodeReports(unittest.TestCase):
+    def setUp(self):
+        """Prepare for a single test."""
+        mock.patch("random.randint", return_value=1).start()
+        mock.patch("time.time", return_value=1156727880.0).start()
+        self.subreports = [
+            IPv4Events([IPEvent("5.79.73.204", "AUTO-SPAM"),
+                        IPEvent("95.211.160.147", "GREYLISTED")]),
+            SoftwareName("rps"),
+            RepeatedIPv4Events([
+                RepeatedIPEvent("93.184.216.34", "INVALID-RECIPIENT", 3)]),
+            IPv6Events([
+                IPEvent("2606:2800:220:1:248:1893:25c8:1946",
+                        "VALID-RECIPIENT")]),
+            RepeatedIPv6Events([
+                RepeatedIPEvent("2606:2800:220:1:248:1893:25c8:1946",
+                                "AUTH-FAILED", 7)]),
+            EndOfReport(),
+        ]
+        self.report = ReportClient.generate_report(self.subreports, "dfs",
+                                                   "foo")
+
+    def tearDown(self):
+        """Clean up after a single test."""
+        mock.patch.stopall()
+
+    def check_columns(self, result, usernames):
+        self.assertEqual(list(result["family"]), [4, 4, 6, 4, 6])
+        self.assertEqual(list(result["ipv4"]),
+                         [0x054f49cc, 0x5fd3a093, 0, 0x5db8d822, 0])
+        self.assertEqual(list(result["ipv6_high"]),
+                         [0, 0, 0x2606280002200001, 0, 0x2606280002200001])
+        self.assertEqual(list(result["ipv6_low"]),
+                         [0, 0, 0x0248189325c81946, 0, 0x0248189325c81946])
+        self.assertEqual(list(result["event"]), [
+            EVENTS.index("AUTO-SPAM"), EVENTS.index("GREYLISTED"),
+            EVENTS.index("VALID-RECIPIENT"),
+            EVENTS.index("INVALID-RECIPIENT"), EVENTS.index("AUTH-FAILED")])
+        self.assertEqual(list(result["repeat"]), [1, 1, 1, 3, 7])
+        self.assertEqual(list(result["user"]), [0] * 5)
+        self.assertEqual(usernames, [b"dfs"])
+        self.assertEqual(list(result["timestamp"]), [1156727880] * 5)
+
+    def test_python(self):
+        self.check_columns(*decode_reports([self.report], {"dfs": "foo"},
+                                           use_numpy=False))
+
+    @unittest.skipIf(numpy is None, "NumPy is not available")
+    def test_numpy(self):
+        result, usernames = decode_reports([self.report], {"dfs": "foo"},
+                                           use_numpy=True)
+        self.assertEqual(len(result), 5)
+        self.check_columns(result, usernames)
+
+    def test_multiple_reports(self):
+        result, dummy = decode_reports([self.report] * 3, {"dfs": "foo"},
+                                       use_numpy=False)
+        self.assertEqual(len(result["event"]), 15)
+
+    def test_usernames(self):
+        other = ReportClient.generate_report(self.subreports, "sensor",
+                                             "bar")
+        for use_numpy in (False, True) if numpy else (False,):
+            result, usernames = decode_reports(
+                [self.report, other, self.report],
+                {"dfs": "foo", "sensor": "bar"}, use_numpy=use_numpy)
+            self.assertEqual(usernames, [b"dfs", b"sensor"])
+            # Events are grouped by format, then in report order.
+            self.assertEqual(list(result["user"][:6]), [0, 0, 1, 1, 0, 0])
+
+    def test_bad_password(self):
+        result, dummy = decode_reports([self.report], {"dfs": "bar"},
+                                       use_numpy=False)
+        self.assertEqual(len(result["event"]), 0)
+
+    def test_unknown_user(self):
+        result, dummy = decode_reports([self.report], {}, use_numpy=False)
+        self.assertEqual(len(result["event"]), 0)
+
+    def test_malformed(self):
+        reports = [b"", b"\x02", b"\x02\x03dfs" + b"\x00" * 30, self.report]
+        result, dummy = decode_reports(reports, {"dfs": "foo"},
+                                       use_numpy=False)
+        self.assertEqual(len(result["event"]), 5)
+
+    def test_invalid_length(self):
+        subreport = bytes(IPv4Events([IPEvent("5.79.73.204", "AUTO-SPAM")]))
+        # Claim a length that is not a multiple of the record length.
+        subreport = b"\x01\x00\x04" + subreport[3:7]
+        report = ReportClient.generate_report(
+            [self.subreports[0], _Raw(subreport), EndOfReport()],
+            "dfs", "foo")
+        result, dummy = decode_reports([report], {"dfs": "foo"},
+                                       use_numpy=False)
+        self.assertEqual(len(result["event"]), 0)
+
+    def test_unknown_format(self):
+        report = ReportClient.generate_report(
+            [_Raw(b"\xf0\x00\x02ab"), self.subreports[0], EndOfReport()],
+            "dfs", "foo")
+        result, dummy = decode_reports([report], {"dfs": "foo"},
+                                       use_numpy=False)
+        self.assertEqual(len(result["event"]), 2)
+
+    def check_ignored(self, subreport, username="dfs"):
+        report = ReportClient.generate_report(
+            [self.subreports[0], _Raw(subreport), EndOfReport()],
+            username, "foo")
+        result, dummy = decode_reports([report], {username: "foo"},
+                                       use_numpy=False)
+        self.assertEqual(len(result["event"]), 0)
+
+    def test_invalid_repeat(self):
+        # 93.184.216.34, INVALID-RECIPIENT, repeated 0 or 1 times.
+        for repeat in (b"\x00", b"\x01"):
+            self.check_ignored(b"\x03\x00\x06\x5d\xb8\xd8\x22\x08" + repeat)
+
+    def test_unknown_event(self):
+        self.check_ignored(b"\x01\x00\x05\x05\x4f\x49\xcc" +
+                           bytes([len(EVENTS)]))
+
+    def test_long_software_name(self):
+        self.check_ignored(b"\x06\x00\x40" + b"x" * 64)
+
+    def test_long_username(self):
+        report = ReportClient.generate_report(self.subreports, "dfs", "foo")
+        username = b"u" * 64
+        # generate_report() refuses long usernames, so splice one in.
+        signed = b"\x02\x40" + username + report[5:-10]
+        report = signed + hmac.new(b"foo", signed, hashlib.sha1).digest()[:10]
+        result, dummy = decode_reports([report], {"u" * 64: "foo"},
+                                       use_numpy=False)
+        self.assertEqual(len(result["event"]), 0)
+
+
+class _Raw(object):
+    """Pre-encoded subreport data."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def __bytes__(self):
+        return self.data
@@ -0,0 +1,334 @@
+"""Test rps.cli"""
+
+import io
+import socket
+import argparse
+import tempfile
+import unittest
+import ipaddress
+
+import mock
+
+from rps.cli import Stats
+from rps.cli import submit
+from rps.cli import make_server
+from rps.cli import parse_line
+from rps.cli import server_main
+from rps.cli import load_handler
+from rps.cli import report_main
+from rps.cli import InvalidLine
+from rps.cli import PrintHandler
+from rps.cli import ReportPacker
+from rps.cli import UnreportableAddress
+from rps.bulk import decode_reports
+from rps.report import EVENTS
+from rps.report import IPEvent
+from rps.report import IPv4Events
+from rps.report import EndOfReport
+from rps.report import ReportClient
+from rps.report import ReportServer
+from rps.report import RequestHandler
+from rps.report import RepeatedIPEvent
+from rps.report import PooledReportServer
+from rps.report import RepeatedIPv4Events
+
+
+class TestParseLine(unittest.TestCase):
+    def test_text(self):
+        self.assertEqual(parse_line("5.79.73.204 AUTO-SPAM\n"),
+                         (ipaddress.ip_address("5.79.73.204"),
+                          "AUTO-SPAM", 1))
+
+    def test_text_count(self):
+        self.assertEqual(parse_line("2606:2800:220:1:248:1893:25c8:1946 "
+                                    "auth-failed 12"),
+                         (ipaddress.ip_address(
+                             "2606:2800:220:1:248:1893:25c8:1946"),
+                          "AUTH-FAILED", 12))
+
+    def test_json(self):
+        self.assertEqual(parse_line('{"ip": "5.79.73.204", '
+                                    '"event": "VIRUS", "count": 3}'),
+                         (ipaddress.ip_address("5.79.73.204"), "VIRUS", 3))
+
+    def test_blank(self):
+        self.assertIsNone(parse_line("  \n"))
+        self.assertIsNone(parse_line("# comment"))
+
+    def test_invalid(self):
+        for line in ("5.79.73.204", "5.79.73.204 AUTO-SPAM 1 2",
+                     "not-an-ip AUTO-SPAM", "5.79.73.204 NOT-AN-EVENT",
+                     "5.79.73.204 RESERVED", "5.79.73.204 AUTO-SPAM 0",
+                     "5.79.73.204 AUTO-SPAM x", '{"ip": "5.79.73.204"}',
+                     "{not json"):
+            self.assertRaises(InvalidLine, parse_line, line)
+
+    def test_unreportable(self):
+        for line in ("10.0.0.1 AUTO-SPAM", "127.0.0.1 AUTO-SPAM",
+                     "fe80::1 AUTO-SPAM"):
+            self.assertRaises(UnreportableAddress, parse_line, line)
+
+
+class TestReportPacker(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+
+    def pack(self, events, max_size=400):
+        packer = ReportPacker(self.sent.append, "dfs", max_size,
+                              software_name="rps")
+        for line in events:
+            packer.add(*parse_line(line))
+        packer.flush()
+        return [ReportClient.generate_report(subreports, "dfs", "foo")
+                for subreports in self.sent]
+
+    def test_size(self):
+        lines = ["5.79.%d.%d AUTO-SPAM" % (i // 250, i % 250 + 1)
+                 for i in range(500)]
+        lines += ["2606:2800:220:1::%x VIRUS 3" % (i + 1) for i in range(50)]
+        reports = self.pack(lines)
+        # The SoftwareName and EndOfReport are added by ReportClient.
+        self.assertTrue(all(len(report) <= 400 - 6 - 1 for report in reports))
+        result, dummy = decode_reports(reports, {"dfs": "foo"},
+                                       use_numpy=False)
+        self.assertEqual(len(result["event"]), 550)
+        # Every report except the last is as full as possible: there is
+        # not room for another subreport header and repeated IPv6 event.
+        for report in reports[:-1]:
+            self.assertGreater(len(report), 400 - 7 - 3 - 18)
+
+    def test_repeat(self):
+        reports = self.pack(["5.79.73.204 AUTO-SPAM 600"])
+        result, dummy = decode_reports(reports, {"dfs": "foo"},
+                                       use_numpy=False)
+        self.assertEqual(sorted(result["repeat"]), [90, 255, 255])
+        self.assertEqual(set(result["event"]), {EVENTS.index("AUTO-SPAM")})
+
+    def test_too_small(self):
+        self.assertRaises(ValueError, ReportPacker, None, "dfs", 40)
+
+    def test_too_large(self):
+        self.assertRaises(ValueError, ReportPacker, None, "dfs", 65508)
+
+
+class TestSubmit(unittest.TestCase):
+    def test_coalesce(self):
+        packer = mock.Mock()
+        stats = Stats()
+        submit(["5.79.73.204 AUTO-SPAM", "5.79.73.204 AUTO-SPAM 2",
+                "5.79.73.204 VIRUS", "10.0.0.1 VIRUS", "junk", ""],
+               packer, stats)
+        address = ipaddress.ip_address("5.79.73.204")
+        packer.add.assert_has_calls([mock.call(address, "AUTO-SPAM", 3),
+                                     mock.call(address, "VIRUS", 1)])
+        packer.flush.assert_called_once_with()
+        self.assertEqual(stats["lines"], 6)
+        self.assertEqual(stats["coalesced"], 1)
+        self.assertEqual(stats["invalid"], 1)
+        self.assertEqual(stats["unreportable"], 1)
+
+    def test_window(self):
+        packer = mock.Mock()
+        submit(["5.79.73.%d AUTO-SPAM" % i for i in range(1, 11)],
+               packer, Stats(), window=2)
+        # The oldest pairs are passed on as soon as the window is full.
+        self.assertEqual(packer.add.call_args_list[0],
+                         mock.call(ipaddress.ip_address("5.79.73.1"),
+                                   "AUTO-SPAM", 1))
+        self.assertEqual(packer.add.call_count, 10)
+
+
+class _RecordingHandler(RequestHandler):
+    def get_password(self, username):
+        return "foo"
+
+    def handle_events(self, username, events, software_name,
+                      software_version, end_user):
+        self.server.handled.append((events, software_name, end_user))
+
+
+class _RecordingServer(ReportServer):
+    handler_class = _RecordingHandler
+    handler_klass = _RecordingHandler
+    signal_reload = None
+    signal_shutdown = None
+    timeout = 0.5
+
+    def __init__(self):
+        self.handled = []
+        super(_RecordingServer, self).__init__(("127.0.0.1", 0))
+
+    def receive(self, count):
+        """Handle count reports, or fewer if they do not arrive."""
+        for dummy in range(count):
+            self.handle_request()
+        return self.handled
+
+
+class TestReportMain(unittest.TestCase):
+    def test_send(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(receiver.close)
+        receiver.bind(("127.0.0.1", 0))
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as events:
+            for i in range(1, 201):
+                events.write("5.79.73.%d AUTO-SPAM 2\n" % i)
+            events.write('{"ip": "5.79.73.1", "event": "AUTO-SPAM"}\n')
+            events.flush()
+            status = report_main([
+                "--port", str(receiver.getsockname()[1]),
+                "--username", "dfs", "--password", "foo",
+                "--progress", "0", events.name])
+        self.assertEqual(status, 0)
+        reports = []
+        receiver.settimeout(0.5)
+        try:
+            while True:
+                reports.append(receiver.recv(65536))
+        except socket.timeout:
+            pass
+        result, dummy = decode_reports(reports, {"dfs": "foo"},
+                                       use_numpy=False)
+        self.assertEqual(len(result["event"]), 200)
+        self.assertEqual(sum(result["repeat"]), 401)
+        self.assertTrue(all(len(report) <= 1400 for report in reports))
+
+    def test_large_report(self):
+        # Reports larger than socketserver's default max_packet_size are
+        # not truncated.
+        server = _RecordingServer()
+        self.addCleanup(server.server_close)
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as events:
+            for i in range(3000):
+                events.write("5.79.%d.%d AUTO-SPAM\n" % (i // 250,
+                                                         i % 250 + 1))
+            events.flush()
+            status = report_main([
+                "--port", str(server.server_address[1]),
+                "--username", "dfs", "--password", "foo",
+                "--max-size", "20000", "--progress", "0", events.name])
+        self.assertEqual(status, 0)
+        handled = server.receive(1)
+        self.assertEqual(len(handled), 1)
+        self.assertEqual(len(handled[0][0]), 3000)
+
+    def test_end_user(self):
+        server = _RecordingServer()
+        self.addCleanup(server.server_close)
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as events:
+            events.write("5.79.73.204 AUTO-SPAM\n")
+            events.flush()
+            status = report_main([
+                "--port", str(server.server_address[1]),
+                "--username", "dfs", "--password", "foo",
+                "--software-name", "rps", "--end-user", "customer-42",
+                "--progress", "0", events.name])
+        self.assertEqual(status, 0)
+        [(events, software_name, end_user)] = server.receive(1)
+        self.assertEqual([(str(event.address), event.event)
+                          for event in events],
+                         [("5.79.73.204", "AUTO-SPAM")])
+        self.assertEqual(software_name, b"rps")
+        self.assertEqual(end_user, b"customer-42")
+
+    def test_invalid_arguments(self):
+        for arguments in (["--max-size", "40"], ["--max-size", "65508"],
+                          ["--software-name", "x" * 64],
+                          ["--software-name", "rps",
+                           "--software-version", "1" * 32],
+                          ["--software-version", "1.0"],
+                          ["--end-user", "\u00e9" * 16],
+                          ["--username", "x" * 64]):
+            with mock.patch("sys.stderr"):
+                self.assertRaises(SystemExit, report_main, [
+                    "--username", "dfs", "--password", "foo"] + arguments)
+
+
+class TestLoadHandler(unittest.TestCase):
+    def test_load(self):
+        self.assertIs(load_handler("rps.cli:PrintHandler"), PrintHandler)
+
+    def test_invalid(self):
+        for name in ("rps.report", "nosuchmodule:Handler",
+                     "rps.report:NoSuchHandler", "rps.report:ReportServer",
+                     "rps.report:VERSION", ":RequestHandler"):
+            self.assertRaises(argparse.ArgumentTypeError, load_handler, name)
+
+    def test_server_main(self):
+        for name in ("rps.report", "nosuchmodule:Handler"):
+            with mock.patch("sys.stderr"):
+                self.assertRaises(SystemExit, server_main,
+                                  ["--handler", name])
+
+
+class TestMakeServer(unittest.TestCase):
+    def setUp(self):
+        # The servers must not take over the test process's signals.
+        patcher = mock.patch("signal.signal")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.stdout = io.StringIO()
+        patcher = mock.patch("sys.stdout", self.stdout)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def send(self, server, password="foo"):
+        report = ReportClient.generate_report([
+            IPv4Events([IPEvent("5.79.73.204", "AUTO-SPAM")]),
+            RepeatedIPv4Events([
+                RepeatedIPEvent("93.184.216.34", "INVALID-RECIPIENT", 3)]),
+            EndOfReport()], "dfs", password)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(sender.close)
+        sender.sendto(report, server.server_address)
+        server.timeout = 1
+        server.handle_request()
+
+    def test_print(self):
+        server = make_server(("127.0.0.1", 0), PrintHandler, {"dfs": "foo"})
+        self.addCleanup(server.server_close)
+        self.send(server)
+        self.assertEqual(self.stdout.getvalue(),
+                         "5.79.73.204 AUTO-SPAM 1\n"
+                         "93.184.216.34 INVALID-RECIPIENT 3\n")
+        self.assertEqual(server.report_count, 1)
+
+    def test_wrong_password(self):
+        server = make_server(("127.0.0.1", 0), PrintHandler, {"dfs": "foo"})
+        self.addCleanup(server.server_close)
+        self.send(server, password="bar")
+        self.assertEqual(self.stdout.getvalue(), "")
+        self.assertEqual(server.report_count, 0)
+
+    def test_pooled(self):
+        server = make_server(("127.0.0.1", 0), PrintHandler, {"dfs": "foo"},
+                             workers=2, queue_size=10)
+        self.assertIsInstance(server, PooledReportServer)
+        self.assertEqual(len(server.worker_threads), 2)
+        self.send(server)
+        # Closing waits for the workers to handle the queued report.
+        server.server_close()
+        self.assertEqual(server.report_count, 1)
+        self.assertIn("93.184.216.34 INVALID-RECIPIENT 3\n",
+                      self.stdout.getvalue())
+
+    def test_handler_passwords(self):
+        # A handler with its own get_password() is used as it is.
+        server = make_server(("127.0.0.1", 0), _RecordingHandler, {})
+        self.addCleanup(server.server_close)
+        self.assertIs(server.handler_class, _RecordingHandler)
+        server.handled = []
+        self.send(server)
+        self.assertEqual(len(server.handled), 1)
+
+    def test_server_main(self):
+        with mock.patch.object(ReportServer, "serve_forever",
+                               side_effect=KeyboardInterrupt), \
+                self.assertLogs("ip-reputation", "INFO") as logs:
+            self.assertEqual(server_main(["--port", "0", "--user", "dfs:foo",
+                                          "--workers", "2"]), 0)
+        self.assertIn("Processed 0 reports", logs.output[-1])
+
+    def test_server_main_invalid_user(self):
+        with mock.patch("sys.stderr"):
+            self.assertRaises(SystemExit, server_main, ["--user", "dfs"])
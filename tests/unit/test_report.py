@@ -2,16 +2,31 @@
 
 from __future__ import print_function
 
+import os
+import time
+import socket
+import logging
+import tempfile
 import unittest
+import threading
 
 import mock
 
+from rps.report import BLOCK
+from rps.report import DROP_NEWEST
+from rps.report import DROP_OLDEST
 from rps.report import IPEvent
 from rps.report import IPv4Events
 from rps.report import IPv6Events
+from rps.report import EndOfReport
 from rps.report import ReportClient
+from rps.report import ReportServer
+from rps.report import RequestHandler
 from rps.report import RepeatedIPEvent
 from rps.report import RepeatedIPv4Events
+from rps.report import RepeatedIPv6Events
+from rps.report import PooledReportServer
+from rps.report import read_socket_drops
 
 
 # XXX These should be reformatted to proper unittests
@@ -31,7 +46,7 @@ class TestReport(unittest.TestCase):
         # The report is from the user "dfs" with password "foo".
         subreports = [
             IPv4Events([IPEvent("5.79.73.204", "AUTO-SPAM"),
-                        IPEvent("95.211.160.147", "GREYLISTED")]),
+                        IPEvent("5.79.65.71", "GREYLISTED")]),
             RepeatedIPv4Events([
                 RepeatedIPEvent("93.184.216.34", "INVALID-RECIPIENT", 3)]),
             IPv6Events([
@@ -53,6 +68,293 @@ class TestReport(unittest.TestCase):
         self.assertEqual(hex_report, correct)
 
 
+class _BlockingHandler(RequestHandler):
+    def handle(self):
+        self.server.release.wait()
+        self.server.handled.append(self.request[0])
+
+
+class _CountingHandler(RequestHandler):
+    def get_password(self, username):
+        return "foo"
+
+    def handle_events(self, username, events, software_name,
+                      software_version, end_user):
+        self.server.handled.append(events)
+
+
+class _TestServer(PooledReportServer):
+    handler_class = _BlockingHandler
+    handler_klass = _BlockingHandler
+    signal_reload = None
+    signal_shutdown = None
+
+    def __init__(self, *args, **kwargs):
+        self.release = threading.Event()
+        self.handled = []
+        super(_TestServer, self).__init__(("127.0.0.1", 0), *args, **kwargs)
+
+
+class _CountingServer(_TestServer):
+    handler_class = _CountingHandler
+    handler_klass = _CountingHandler
+
+
+class TestPooledReportServer(unittest.TestCase):
+    client_address = ("127.0.0.1", 9)
+
+    def fill(self, server, count):
+        """Give the server count requests, after the single worker is busy
+        with the first."""
+        server.process_request((b"0", server.socket), self.client_address)
+        while not server.queue.empty():
+            time.sleep(0.001)
+        for i in range(1, count):
+            server.process_request((str(i).encode("ascii"), server.socket),
+                                   self.client_address)
+
+    def finish(self, server):
+        server.release.set()
+        server.server_close()
+        return server.handled
+
+    def test_drop_newest(self):
+        server = _TestServer(workers=1, queue_size=1, overflow=DROP_NEWEST)
+        self.fill(server, 3)
+        self.assertEqual(self.finish(server), [b"0", b"1"])
+        self.assertEqual(server.overflow_counts[DROP_NEWEST], 1)
+
+    def test_drop_oldest(self):
+        server = _TestServer(workers=1, queue_size=1, overflow=DROP_OLDEST)
+        self.fill(server, 4)
+        self.assertEqual(self.finish(server), [b"0", b"3"])
+        self.assertEqual(server.overflow_counts[DROP_OLDEST], 2)
+
+    def test_block(self):
+        server = _TestServer(workers=1, queue_size=1, overflow=BLOCK)
+        filler = threading.Thread(target=self.fill, args=(server, 3))
+        filler.start()
+        while not server.overflow_counts[BLOCK]:
+            time.sleep(0.001)
+        self.assertTrue(filler.is_alive())
+        self.assertEqual(self.finish(server), [b"0", b"1", b"2"])
+        filler.join()
+
+    def test_invalid_policy(self):
+        self.assertRaises(AssertionError, _TestServer, overflow="drop-all")
+
+    def test_replay_across_workers(self):
+        server = _CountingServer(workers=8)
+        report = ReportClient.generate_report([
+            IPv4Events([IPEvent("5.79.73.204", "AUTO-SPAM")]),
+            EndOfReport()], "dfs", "foo")
+        for dummy in range(50):
+            server.process_request((report, server.socket),
+                                   self.client_address)
+        self.finish(server)
+        self.assertEqual(len(server.handled), 1)
+        self.assertEqual(server.report_count, 1)
+        self.assertEqual(len(server.recent_reports), 1)
+
+
+class _Raw(object):
+    """Pre-encoded subreport data."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def __bytes__(self):
+        return self.data
+
+
+class TestRequestHandler(unittest.TestCase):
+    client_address = ("127.0.0.1", 9)
+
+    def handle_report(self, report):
+        server = _CountingServer(workers=1)
+        server.release.set()
+        server.process_request((report, server.socket), self.client_address)
+        server.server_close()
+        return server.handled
+
+    def handle(self, data):
+        """Handle a report with a valid subreport followed by data."""
+        return self.handle_report(ReportClient.generate_report([
+            IPv4Events([IPEvent("5.79.73.204", "AUTO-SPAM")]),
+            _Raw(data), EndOfReport()], "dfs", "foo"))
+
+    def round_trip(self, subreports):
+        """Return the (address, event, repeat) tuples handled from a report
+        of the subreports."""
+        handled = self.handle_report(ReportClient.generate_report(
+            subreports + [EndOfReport()], "dfs", "foo"))
+        self.assertEqual(len(handled), 1)
+        return [(str(event.address), event.event,
+                 getattr(event, "repeat", None)) for event in handled[0]]
+
+    def test_ipv4(self):
+        self.assertEqual(self.round_trip([
+            IPv4Events([IPEvent("5.79.73.204", "AUTO-SPAM"),
+                        IPEvent("93.184.216.34", "AUTH-FAILED")])]),
+            [("5.79.73.204", "AUTO-SPAM", None),
+             ("93.184.216.34", "AUTH-FAILED", None)])
+
+    def test_repeated_ipv4(self):
+        self.assertEqual(self.round_trip([
+            RepeatedIPv4Events([
+                RepeatedIPEvent("93.184.216.34", "INVALID-RECIPIENT", 3),
+                RepeatedIPEvent("5.79.73.204", "AUTO-SPAM", 255)])]),
+            [("93.184.216.34", "INVALID-RECIPIENT", 3),
+             ("5.79.73.204", "AUTO-SPAM", 255)])
+
+    def test_ipv6(self):
+        address = "2606:2800:220:1:248:1893:25c8:1946"
+        self.assertEqual(self.round_trip([
+            IPv6Events([IPEvent(address, "VALID-RECIPIENT")]),
+            RepeatedIPv6Events([RepeatedIPEvent(address, "VIRUS", 7)])]),
+            [(address, "VALID-RECIPIENT", None), (address, "VIRUS", 7)])
+
+    def test_wrong_password(self):
+        report = ReportClient.generate_report([
+            IPv4Events([IPEvent("5.79.73.204", "AUTO-SPAM")]),
+            EndOfReport()], "dfs", "bar")
+        self.assertEqual(self.handle_report(report), [])
+
+    def test_wrong_version(self):
+        report = ReportClient.generate_report([
+            IPv4Events([IPEvent("5.79.73.204", "AUTO-SPAM")]),
+            EndOfReport()], "dfs", "foo")
+        self.assertEqual(self.handle_report(b"\x03" + report[1:]), [])
+
+    def test_repeat_too_small(self):
+        self.assertEqual(
+            self.handle(b"\x03\x00\x06\x05\x4f\x49\xcc\x03\x01"), [])
+
+    def test_truncated(self):
+        self.assertEqual(self.handle(b"\x01\x00\x0a\x05\x4f\x49\xcc\x01"),
+                         [])
+
+    def test_unknown_event(self):
+        self.assertEqual(self.handle(b"\x01\x00\x05\x05\x4f\x49\xcc\xff"),
+                         [])
+
+    def test_unknown_repeated_event(self):
+        self.assertEqual(
+            self.handle(b"\x03\x00\x06\x05\x4f\x49\xcc\xff\x02"), [])
+
+    def test_unknown_format(self):
+        handled = self.handle(b"\xc8\x00\x02\x01\x02")
+        self.assertEqual(len(handled), 1)
+        self.assertEqual(len(handled[0]), 1)
+
+
+class _PlainServer(ReportServer):
+    signal_reload = None
+    signal_shutdown = None
+
+
+class TestReportServer(unittest.TestCase):
+    def test_receive_buffer(self):
+        server = _PlainServer(("127.0.0.1", 0), receive_buffer=65536)
+        self.addCleanup(server.server_close)
+        self.assertGreaterEqual(server.receive_buffer_size, 65536)
+        self.assertGreaterEqual(
+            server.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF),
+            65536)
+
+    def test_receive_buffer_not_honoured(self):
+        with self.assertLogs("ip-reputation", "WARNING"):
+            server = _PlainServer(("127.0.0.1", 0), receive_buffer=2 ** 30)
+        self.addCleanup(server.server_close)
+        self.assertLess(server.receive_buffer_size, 2 ** 30)
+
+    def check_receive_buffer(self, platform, size):
+        """Return the warnings logged if the kernel reports a receive
+        buffer of size after a request for 65536 bytes."""
+        with mock.patch("sys.platform", platform), \
+                mock.patch.object(socket.socket, "getsockopt",
+                                  return_value=size):
+            with self.assertLogs("ip-reputation") as logs:
+                server = _PlainServer(("127.0.0.1", 0), receive_buffer=65536)
+                logging.getLogger("ip-reputation").info("Started.")
+        self.addCleanup(server.server_close)
+        self.assertEqual(server.receive_buffer_size, size)
+        return [record for record in logs.records
+                if record.levelno == logging.WARNING]
+
+    def test_receive_buffer_doubled(self):
+        self.assertEqual(self.check_receive_buffer("linux", 131072), [])
+
+    def test_receive_buffer_capped(self):
+        # Linux doubles net.core.rmem_max, which is 32768 here.
+        self.assertEqual(len(self.check_receive_buffer("linux", 65536)), 1)
+
+    def test_receive_buffer_not_doubled(self):
+        self.assertEqual(self.check_receive_buffer("darwin", 65536), [])
+        self.assertEqual(len(self.check_receive_buffer("darwin", 32768)), 1)
+
+    def test_drop_sample_thread(self):
+        server = _PlainServer(("127.0.0.1", 0))
+        server.drop_sample_interval = 0.01
+        sampled = threading.Event()
+        threads = []
+
+        def sample_drops():
+            threads.append(threading.current_thread())
+            sampled.set()
+
+        server.sample_drops = sample_drops
+        serving = threading.Thread(target=server.serve_forever)
+        serving.start()
+        self.assertTrue(sampled.wait(5))
+        server.shutdown()
+        serving.join()
+        server.server_close()
+        # /proc/net/udp is not read by the thread that reads the socket.
+        self.assertNotIn(serving, threads)
+        self.assertIsNone(server.drop_sample_thread)
+
+    def test_no_drop_sample_thread(self):
+        server = _PlainServer(("127.0.0.1", 0))
+        self.addCleanup(server.server_close)
+        server.drop_sample_interval = 0
+        serving = threading.Thread(target=server.serve_forever)
+        serving.start()
+        server.shutdown()
+        serving.join()
+        self.assertIsNone(server.drop_sample_thread)
+
+    @unittest.skipIf(not os.path.exists("/proc/net/udp"),
+                     "/proc/net/udp is not available")
+    def test_dropped_count(self):
+        server = _PlainServer(("127.0.0.1", 0), receive_buffer=4096)
+        self.addCleanup(server.server_close)
+        self.assertEqual(server.dropped_count, 0)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(sender.close)
+        for dummy in range(100):
+            sender.sendto(b"x" * 1000, server.server_address)
+        self.assertGreater(server.sample_drops(), 0)
+        self.assertGreater(server.receive_queue, 0)
+
+    def test_read_socket_drops(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(sock.close)
+        inode = os.fstat(sock.fileno()).st_ino
+        with tempfile.NamedTemporaryFile("w") as proc_file:
+            proc_file.write(
+                "  sl  local_address rem_address   st tx_queue rx_queue tr "
+                "tm->when retrnsmt   uid  timeout inode ref pointer drops\n"
+                " 1970: 0100007F:9B55 00000000:0000 07 00000000:00000340 "
+                "00:00000000 00000000     0        0 %d 2 000000005820aad9 "
+                "17\n" % inode)
+            proc_file.flush()
+            self.assertEqual(read_socket_drops(sock, [proc_file.name]),
+                             (17, 0x340))
+            self.assertEqual(read_socket_drops(sock, ["/nonexistent"]),
+                             (None, None))
+
+
 class MockTest(unittest.TestCase):
     def test_1(self):
         self.assertEqual(1, 1)
@@ -0,0 +1,250 @@
+"""Test rps.sketch"""
+
+import sys
+import random
+import unittest
+import threading
+import ipaddress
+import collections
+
+import mock
+
+from rps.report import IPEvent
+from rps.report import RepeatedIPEvent
+from rps.sketch import SpaceSaving
+from rps.sketch import HeavyHitters
+from rps.sketch import SlidingWindow
+from rps.sketch import CountMinSketch
+from rps.sketch import TumblingWindow
+
+
+def _stream(heavy=10, light=5000, seed=1):
+    """A stream of keys where a few keys are far more frequent."""
+    rng = random.Random(seed)
+    keys = [b"heavy%d" % i for i in range(heavy) for dummy in range(200)]
+    keys += [b"light%d" % rng.randint(0, light) for dummy in range(5000)]
+    rng.shuffle(keys)
+    return keys
+
+
+class TestCountMinSketch(unittest.TestCase):
+    def test_estimate(self):
+        sketch = CountMinSketch(width=256, depth=4)
+        keys = _stream()
+        for key in keys:
+            sketch.add(key)
+        counts = collections.Counter(keys)
+        for key, count in counts.items():
+            estimate = sketch.estimate(key)
+            self.assertGreaterEqual(estimate, count)
+        self.assertLess(sketch.estimate(b"heavy0") - 200,
+                        2.0 / 256 * len(keys))
+        self.assertEqual(sketch.total, len(keys))
+
+    def test_merge(self):
+        first, second = CountMinSketch(64), CountMinSketch(64)
+        first.add(b"a", 3)
+        second.add(b"a", 4)
+        second.add(b"b")
+        first.merge(second)
+        self.assertGreaterEqual(first.estimate(b"a"), 7)
+        self.assertEqual(first.total, 8)
+
+    def test_merge_incompatible(self):
+        self.assertRaises(AssertionError, CountMinSketch(64).merge,
+                          CountMinSketch(64, seed=1))
+
+
+class TestSpaceSaving(unittest.TestCase):
+    def test_top(self):
+        summary = SpaceSaving(k=50)
+        for key in _stream():
+            summary.add(key)
+        top = set(key for key, dummy, dummy in summary.top(10))
+        self.assertEqual(top, set(b"heavy%d" % i for i in range(10)))
+        for key, count, error in summary.top(10):
+            self.assertLessEqual(count - error, 200)
+            self.assertGreaterEqual(count, 200)
+        self.assertEqual(len(summary.counts), 50)
+
+    def test_merge(self):
+        keys = _stream()
+        first, second = SpaceSaving(k=50), SpaceSaving(k=50)
+        for i, key in enumerate(keys):
+            (first if i % 2 else second).add(key)
+        first.merge(second)
+        top = set(key for key, dummy, dummy in first.top(10))
+        self.assertEqual(top, set(b"heavy%d" % i for i in range(10)))
+        self.assertEqual(first.total, len(keys))
+        self.assertEqual(len(first.counts), 50)
+
+
+class TestHeavyHitters(unittest.TestCase):
+    def test_events(self):
+        heavy_hitters = HeavyHitters(k=10, width=128)
+        heavy_hitters.add_events([
+            IPEvent("5.79.73.204", "AUTO-SPAM"),
+            RepeatedIPEvent("5.79.73.204", "AUTO-SPAM", 5),
+            RepeatedIPEvent("95.211.160.147", "AUTO-SPAM", 3),
+            IPEvent("95.211.160.147", "AUTH-FAILED"),
+        ])
+        self.assertEqual(heavy_hitters.top("AUTO-SPAM"), [
+            (ipaddress.ip_address("5.79.73.204"), 6),
+            (ipaddress.ip_address("95.211.160.147"), 3)])
+        self.assertEqual(heavy_hitters.top("AUTH-FAILED", 1), [
+            (ipaddress.ip_address("95.211.160.147"), 1)])
+        self.assertEqual(heavy_hitters.top("VIRUS"), [])
+        self.assertEqual(heavy_hitters.estimate("5.79.73.204", "AUTO-SPAM"),
+                         6)
+        self.assertEqual(heavy_hitters.estimate("5.79.73.204", "VIRUS"), 0)
+
+    def test_copy(self):
+        heavy_hitters = HeavyHitters(k=10)
+        heavy_hitters.add_events([IPEvent("5.79.73.204", "AUTO-SPAM"),
+                                  IPEvent("5.79.73.204", "VIRUS")])
+        copy = heavy_hitters.copy("VIRUS")
+        heavy_hitters.add_events([IPEvent("5.79.73.204", "VIRUS")])
+        self.assertEqual(list(copy.sketches), ["VIRUS"])
+        self.assertEqual(copy.estimate("5.79.73.204", "VIRUS"), 1)
+        self.assertEqual(copy.top("VIRUS"), [
+            (ipaddress.ip_address("5.79.73.204"), 1)])
+        self.assertEqual(heavy_hitters.copy().estimate("5.79.73.204",
+                                                       "VIRUS"), 2)
+
+    def test_merge(self):
+        first, second = HeavyHitters(k=10), HeavyHitters(k=10)
+        first.add_events([IPEvent("5.79.73.204", "AUTO-SPAM")])
+        second.add_events([RepeatedIPEvent("5.79.73.204", "AUTO-SPAM", 2),
+                           IPEvent("5.79.73.204", "VIRUS")])
+        first.merge(second)
+        self.assertEqual(first.top("AUTO-SPAM"), [
+            (ipaddress.ip_address("5.79.73.204"), 3)])
+        self.assertEqual(first.top("VIRUS"), [
+            (ipaddress.ip_address("5.79.73.204"), 1)])
+
+
+class TestWindows(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.clock = mock.Mock(side_effect=lambda: self.now)
+        self.event = [IPEvent("5.79.73.204", "AUTO-SPAM")]
+
+    def test_tumbling(self):
+        window = TumblingWindow(60, HeavyHitters(k=10), clock=self.clock)
+        window.add_events(self.event)
+        window.add_events(self.event)
+        self.assertEqual(window.estimate("5.79.73.204", "AUTO-SPAM"), 2)
+        self.now += 60
+        self.assertEqual(window.estimate("5.79.73.204", "AUTO-SPAM"), 0)
+        self.assertEqual(window.estimate("5.79.73.204", "AUTO-SPAM",
+                                         complete=True), 2)
+        self.now += 120
+        self.assertEqual(window.top("AUTO-SPAM", complete=True), [])
+
+    def test_tumbling_query_locked(self):
+        # Adding events may evict keys from the current window, so it
+        # must be queried with the lock held.
+        window = TumblingWindow(60, HeavyHitters(k=10), clock=self.clock)
+        window.add_events(self.event)
+        held = []
+
+        def check(original):
+            def checked(heavy_hitters, *args):
+                held.append(window.lock.locked())
+                return original(heavy_hitters, *args)
+            return checked
+
+        with mock.patch.object(HeavyHitters, "top", autospec=True,
+                               side_effect=check(HeavyHitters.top)), \
+                mock.patch.object(HeavyHitters, "estimate", autospec=True,
+                                  side_effect=check(HeavyHitters.estimate)):
+            window.top("AUTO-SPAM")
+            window.estimate("5.79.73.204", "AUTO-SPAM", complete=True)
+        self.assertEqual(held, [True, True])
+
+    def test_sliding(self):
+        window = SlidingWindow(60, 6, HeavyHitters(k=10), clock=self.clock)
+        for dummy in range(6):
+            window.add_events(self.event)
+            self.now += 10
+        self.assertEqual(window.top("AUTO-SPAM"), [
+            (ipaddress.ip_address("5.79.73.204"), 5)])
+        self.now += 30
+        self.assertEqual(window.estimate("5.79.73.204", "AUTO-SPAM"), 2)
+        self.now += 60
+        self.assertEqual(window.top("AUTO-SPAM"), [])
+        self.assertEqual(window.buckets, [])
+
+    def test_sliding_merge(self):
+        window = SlidingWindow(60, 6, HeavyHitters(k=10), clock=self.clock)
+        for dummy in range(3):
+            window.add_events(self.event)
+            window.add_events([IPEvent("5.79.73.204", "VIRUS")])
+            self.now += 10
+        window.add_events(self.event)
+        merges = []
+        merge = HeavyHitters.merge
+
+        def checked_merge(heavy_hitters, other, event=None):
+            merges.append((event, window.lock.locked()))
+            return merge(heavy_hitters, other, event)
+
+        with mock.patch.object(HeavyHitters, "merge", autospec=True,
+                               side_effect=checked_merge):
+            self.assertEqual(window.top("AUTO-SPAM"), [
+                (ipaddress.ip_address("5.79.73.204"), 4)])
+        # Only the queried event type is merged, without holding the lock.
+        self.assertEqual(merges, [("AUTO-SPAM", False)] * 4)
+        merged = window.merged("AUTO-SPAM")
+        self.assertEqual(list(merged.sketches), ["AUTO-SPAM"])
+        self.assertEqual(set(window.merged().sketches),
+                         {"AUTO-SPAM", "VIRUS"})
+        # The newest bucket is copied, so is not changed by the merge.
+        self.assertEqual(window.buckets[-1][1].estimate("5.79.73.204",
+                                                        "AUTO-SPAM"), 1)
+
+
+class TestConcurrentWindows(unittest.TestCase):
+    def setUp(self):
+        interval = sys.getswitchinterval()
+        self.addCleanup(sys.setswitchinterval, interval)
+        sys.setswitchinterval(1e-6)
+
+    def query_while_adding(self, window, query, queries=4000):
+        """Run queries while three threads add events, and return any
+        exceptions raised."""
+        stop = threading.Event()
+        errors = []
+
+        def add(seed):
+            rng = random.Random(seed)
+            while not stop.is_set():
+                window.add_events([IPEvent(
+                    "5.79.%d.%d" % (rng.randint(0, 255),
+                                    rng.randint(1, 254)), "AUTO-SPAM")])
+
+        adders = [threading.Thread(target=add, args=(seed,))
+                  for seed in range(3)]
+        for thread in adders:
+            thread.start()
+        try:
+            for dummy in range(queries):
+                try:
+                    query()
+                except Exception as e:
+                    errors.append(e)
+        finally:
+            stop.set()
+            for thread in adders:
+                thread.join()
+        return errors
+
+    def test_tumbling(self):
+        window = TumblingWindow(3600, HeavyHitters(k=20, width=64))
+        self.assertEqual(self.query_while_adding(
+            window, lambda: window.top("AUTO-SPAM", 20)), [])
+
+    def test_sliding(self):
+        window = SlidingWindow(3600, 12, HeavyHitters(k=20, width=64))
+        self.assertEqual(self.query_while_adding(
+            window, lambda: window.top("AUTO-SPAM", 20), queries=500), [])
@@ -0,0 +1,144 @@
+"""Test rps.snapshot"""
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import threading
+
+from rps.report import ReportServer
+from rps.snapshot import SnapshotError
+from rps.snapshot import read_snapshot
+from rps.snapshot import write_snapshot
+
+
+class _StatefulServer(ReportServer):
+    signal_reload = None
+    signal_shutdown = None
+
+    def __init__(self, *args, **kwargs):
+        self.state = b""
+        super(_StatefulServer, self).__init__(*args, **kwargs)
+
+    def dump_state(self):
+        return self.state
+
+    def load_state(self, state):
+        self.state = state
+
+
+class _LateStateServer(_StatefulServer):
+    """Sets up its state after ReportServer.__init__()."""
+
+    def __init__(self, *args, **kwargs):
+        super(_LateStateServer, self).__init__(*args, **kwargs)
+        self.state = b"initial"
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, "snapshot")
+        self.now = int(time.time())
+
+    def test_round_trip(self):
+        recent_reports = {(self.now, b"12345678"), (self.now - 5, b"abcdefgh")}
+        write_snapshot(self.path, recent_reports, b"state")
+        self.assertEqual(read_snapshot(self.path), (recent_reports, b"state"))
+        # Only the snapshot is left in the directory.
+        self.assertEqual(os.listdir(self.directory), ["snapshot"])
+
+    def test_empty(self):
+        write_snapshot(self.path, [])
+        self.assertEqual(read_snapshot(self.path), (set(), b""))
+
+    def test_expired(self):
+        write_snapshot(self.path, [(self.now, b"12345678"),
+                                   (self.now - 600, b"abcdefgh")])
+        self.assertEqual(read_snapshot(self.path)[0],
+                         {(self.now, b"12345678")})
+        self.assertEqual(read_snapshot(self.path, max_age=-1)[0], set())
+
+    def test_replace(self):
+        write_snapshot(self.path, [(self.now, b"12345678")])
+        write_snapshot(self.path, [(self.now, b"abcdefgh")])
+        self.assertEqual(read_snapshot(self.path)[0],
+                         {(self.now, b"abcdefgh")})
+
+    def test_corrupt(self):
+        write_snapshot(self.path, [(self.now, b"12345678")], b"state")
+        with open(self.path, "rb") as snapshot:
+            data = bytearray(snapshot.read())
+        for corrupt in (data[:10], data[:-1], b"XXXX" + data[4:],
+                        data[:-5] + b"x" + data[-4:]):
+            with open(self.path, "wb") as snapshot:
+                snapshot.write(corrupt)
+            self.assertRaises(SnapshotError, read_snapshot, self.path)
+
+    def test_server(self):
+        server = _StatefulServer(("127.0.0.1", 0), snapshot_path=self.path)
+        server.restore_snapshot()
+        server.recent_reports.add((self.now, b"12345678"))
+        server.state = b"aggregated"
+        server.server_close()
+        server = _StatefulServer(("127.0.0.1", 0), snapshot_path=self.path)
+        self.addCleanup(server.server_close)
+        server.restore_snapshot()
+        self.assertEqual(server.recent_reports, {(self.now, b"12345678")})
+        self.assertEqual(server.state, b"aggregated")
+
+    def test_server_state_after_init(self):
+        write_snapshot(self.path, [(self.now, b"12345678")], b"aggregated")
+        server = _LateStateServer(("127.0.0.1", 0), snapshot_path=self.path)
+        self.addCleanup(server.server_close)
+        self.assertEqual(server.state, b"initial")
+        # serve_forever() restores the snapshot before handling anything.
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        server.shutdown()
+        thread.join()
+        self.assertEqual(server.recent_reports, {(self.now, b"12345678")})
+        self.assertEqual(server.state, b"aggregated")
+
+    def test_server_not_restored(self):
+        # Closing a server that never restored the snapshot leaves it.
+        write_snapshot(self.path, [(self.now, b"12345678")], b"aggregated")
+        server = _StatefulServer(("127.0.0.1", 0), snapshot_path=self.path)
+        server.server_close()
+        self.assertEqual(read_snapshot(self.path),
+                         ({(self.now, b"12345678")}, b"aggregated"))
+
+    def test_server_periodic(self):
+        server = _StatefulServer(("127.0.0.1", 0), snapshot_path=self.path)
+        self.addCleanup(server.server_close)
+        server.snapshot_interval = 0.01
+        server.recent_reports.add((self.now, b"12345678"))
+        dump_threads = []
+        dump_state = server.dump_state
+        server.dump_state = lambda: (
+            dump_threads.append(threading.current_thread()) or dump_state())
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        deadline = time.time() + 5
+        while not os.path.exists(self.path) and time.time() < deadline:
+            time.sleep(0.01)
+        server.shutdown()
+        thread.join()
+        self.assertEqual(read_snapshot(self.path)[0],
+                         {(self.now, b"12345678")})
+        # The snapshots are not written by the thread reading the socket.
+        self.assertTrue(dump_threads)
+        self.assertNotIn(thread, dump_threads)
+        server.server_close()
+        self.assertIsNone(server.snapshot_thread)
+
+    def test_server_corrupt(self):
+        with open(self.path, "wb") as snapshot:
+            snapshot.write(b"not a snapshot" * 10)
+        server = _StatefulServer(("127.0.0.1", 0), snapshot_path=self.path)
+        with self.assertLogs("ip-reputation", "ERROR"):
+            server.restore_snapshot()
+        server.server_close()
+        self.assertEqual(read_snapshot(self.path), (set(), b""))